@@ -3,18 +3,24 @@
 from webmailbox.db import get_db
 from webmailbox.fs import get_fs
 from webmailbox.mq import get_mq
-from webmailbox.core import fetch_mails
+from webmailbox.core import FetchEngine
 
 if __name__ == "__main__":
     import settings
-    db = get_db(settings)
-    fs = get_fs(settings)
-    mq = get_mq(settings)
+    # a socket for every worker and one for the dispatcher
+    pool_size = settings.FETCH_CONCURRENCY + 1
+    db = get_db(settings, pool_size)
+    fs = get_fs(settings, pool_size)
+    mq = get_mq(settings, pool_size)
+    db.init_indexes()
+    fs.init_indexes()
 
-    running = True
-    while running:
-        try:
-            fetch_mails(db, fs, mq, settings)
-        except KeyboardInterrupt:
-            print "Exit..."
-            running = False
+    engine = FetchEngine(db, fs, mq, settings.MAX_MAIL_SIZE,
+                         concurrency=settings.FETCH_CONCURRENCY,
+                         batch_size=settings.FETCH_BATCH_SIZE,
+                         wait_timeout=settings.FETCH_WAIT_TIMEOUT,
+                         headers_first=settings.FETCH_HEADERS_FIRST)
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        print "Exit..."
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+import sys
+
+from webmailbox.db import get_db
+from webmailbox.mq import get_mq
+from webmailbox.core import IdleEngine
+
+if __name__ == "__main__":
+    import settings
+    if not settings.IMAP_IDLE:
+        # IMAP mail accounts are polled by the fetcher
+        print "IMAP_IDLE is off, exit..."
+        sys.exit(0)
+    db = get_db(settings)
+    mq = get_mq(settings)
+    db.init_indexes()
+
+    engine = IdleEngine(db, mq, refresh_interval=settings.IDLE_REFRESH_INTERVAL)
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        print "Exit..."
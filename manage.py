@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import sys
+
+from webmailbox.db import get_db
+from webmailbox.fs import get_fs
+
+def init_indexes(db, fs):
+    db.init_indexes()
+    fs.init_indexes()
+
+def check_indexes(db, fs):
+    """ fail if any query of db or fs scans a whole collection """
+    scans = db.check_indexes() + fs.check_indexes()
+    for name in scans:
+        print "collection scan: %s" % name
+    if scans:
+        sys.exit(1)
+    print "All queries use indexes."
+
+def repair_mail_counters(db, fs):
+    db.repair_mail_counters()
+
+def migrate_pop3_uniqueids(db, fs):
+    """ run before the fetcher of this version, or POP3 mails come twice """
+    print "%d mails migrated." % db.migrate_pop3_uniqueids()
+
+commands = {
+    "init_indexes": init_indexes,
+    "check_indexes": check_indexes,
+    "repair_mail_counters": repair_mail_counters,
+    "migrate_pop3_uniqueids": migrate_pop3_uniqueids,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print "usage: %s %s" % (sys.argv[0], "|".join(sorted(commands)))
+        sys.exit(2)
+    import settings
+    db = get_db(settings)
+    fs = get_fs(settings)
+    commands[sys.argv[1]](db, fs)
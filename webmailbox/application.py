@@ -6,6 +6,9 @@ import tornado.web
 from webmailbox.db import get_db
 from webmailbox.fs import get_fs
 from webmailbox.mq import get_mq
+from webmailbox.db.executor import AsyncConnection
+from webmailbox.notify import NewMailNotifier
+from webmailbox.mailstate import MailStateWriter
 from webmailbox.handlers import urls_mapping
 
 __all__ = [
@@ -28,12 +31,29 @@ class WebMailBoxApplication(tornado.web.Application):
 
         app_options["cookie_secret"] = settings.COOKIE_SECRET
         app_options["batch_size"] = settings.BATCH_SIZE
+        app_options["fetch_time_interval"] = settings.FETCH_TIME_INTERVAL
+        app_options["imap_idle"] = settings.IMAP_IDLE
 
         tornado.web.Application.__init__(self, urls_mapping, **app_options)
 
-        self.db = get_db(settings)
-        self.fs = get_fs(settings)
+        # a socket for every worker and one for the IOLoop
+        self.db = get_db(settings, settings.DB_WORKERS + 1)
+        self.fs = get_fs(settings, settings.FS_WORKERS + 1)
         self.mq = get_mq(settings)
+        self.db.init_indexes()
+        self.fs.init_indexes()
+        # for handlers, which must not block the IOLoop on queries
+        self.async_db = AsyncConnection(self.db, settings.DB_WORKERS)
+        self.async_fs = AsyncConnection(self.fs, settings.FS_WORKERS)
+        # for health checks only, the IOLoop sends messages itself
+        self.async_mq = AsyncConnection(self.mq, 1)
+        # new mails published by the fetcher, for /mailbox/updates/
+        self.notifier = NewMailNotifier(self.mq)
+        self.notifier.start()
+        # seen flags of viewed mails are written in bulk
+        self.mail_state = MailStateWriter(self.async_db,
+                                          settings.MAIL_STATE_INTERVAL)
+        self.mail_state.start()
 
 def main():
     import tornado.httpserver
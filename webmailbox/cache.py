@@ -0,0 +1,101 @@
+import time
+import threading
+
+__all__ = [
+    'LRUCache',
+]
+
+class LRUCache(object):
+    """ a thread safe cache of the ``maxsize`` most recently used items
+
+    Items older than ``ttl`` seconds are dropped on lookup, ``ttl=None``
+    keeps them until they are pushed out. Hits and misses are counted.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # links are [prev, next, key, value, expires], root[1] is the most
+        # recently used one and root[0] the least recently used one
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+        self._links = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._links)
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _link_first(self, link):
+        root = self._root
+        link[0] = root
+        link[1] = root[1]
+        root[1][0] = link
+        root[1] = link
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None and link[4] is not None and \
+                link[4] < time.time():
+                self._unlink(link)
+                del self._links[key]
+                link = None
+            if link is None:
+                self.misses += 1
+                return default
+            self._unlink(link)
+            self._link_first(link)
+            self.hits += 1
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                self._unlink(link)
+            link = [None, None, key, value, expires]
+            self._link_first(link)
+            self._links[key] = link
+            if len(self._links) > self.maxsize:
+                oldest = self._root[0]
+                self._unlink(oldest)
+                del self._links[oldest[2]]
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            root = self._root
+            root[:] = [root, root, None, None, None]
+            self._links.clear()
+        finally:
+            self._lock.release()
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._links),
+            'maxsize': self.maxsize,
+        }
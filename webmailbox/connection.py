@@ -0,0 +1,91 @@
+import time
+import logging
+import functools
+import threading
+
+__all__ = [
+    "ReconnectingConnection",
+    "retry_transient",
+    "connect",
+]
+
+MAX_RETRY_DELAY = 5     # seconds
+
+class ReconnectingConnection(object):
+    """ base of connections to servers which may go away for a while
+
+    Subclasses list the errors of a lost server in ``transient_errors``
+    and define reconnect() and ping(). Once the class is decorated with
+    retry_transient, its public methods are tried again up to ``retries``
+    times with growing delays, reconnecting in between. Methods which must
+    not run twice, like inserts and increments, are listed in
+    ``not_retried``.
+    """
+
+    transient_errors = ()
+    not_retried = ()
+    retries = 3
+    retry_delay = 0.1   # seconds before the first retry
+
+    def __init__(self):
+        self._generation = 0
+        self._reconnect_lock = threading.Lock()
+
+    def _load(self, result):
+        """ read lazy results, so their errors are retried too """
+        return result
+
+    def _reconnect_after(self, generation):
+        """ reconnect unless another thread did since ``generation`` """
+        self._reconnect_lock.acquire()
+        try:
+            if self._generation != generation:
+                return
+            try:
+                self.reconnect()
+                self._generation += 1
+            except self.transient_errors as e:
+                logging.warning("reconnect failed: %s" % e)
+        finally:
+            self._reconnect_lock.release()
+
+def _retried(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        delay = self.retry_delay
+        for i in range(self.retries):
+            generation = self._generation
+            try:
+                return self._load(method(self, *args, **kwargs))
+            except self.transient_errors as e:
+                logging.warning("%s failed: %s, retry in %.1f seconds" % \
+                    (method.__name__, e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                self._reconnect_after(generation)
+        return self._load(method(self, *args, **kwargs))
+    return wrapper
+
+def retry_transient(cls):
+    """ class decorator retrying the public methods of a connection """
+    skipped = ("reconnect", "close", "ping") + tuple(cls.not_retried)
+    for name, value in cls.__dict__.items():
+        if name.startswith("_") or name in skipped or not callable(value):
+            continue
+        setattr(cls, name, _retried(value))
+    return cls
+
+def connect(factory, errors, retries=5, delay=1):
+    """ create a connection with ``factory``, trying again while it fails
+
+    Errors other than ``errors`` and the last failure are raised.
+    """
+    for i in range(retries):
+        try:
+            return factory()
+        except errors as e:
+            logging.error("Can not get connection: %s, retry in %d "
+                          "seconds..." % (e, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+    return factory()
@@ -5,4 +5,11 @@ MAIL_PROTOCOLS = [
 
 SUPPORTED_MAIL_PROTOCOLS = (
     "pop3",
+    "imap",
 )
+
+FETCH_MAILS_CHANNEL = "mail_accounts:fetch_mails"
+# bodies of mails stored with headers only, served after FETCH_MAILS_CHANNEL
+FETCH_BODIES_CHANNEL = "mail_accounts:fetch_bodies"
+# published by the fetcher for every fetch storing new mails
+NEW_MAILS_CHANNEL = "users:new_mails"
@@ -1,26 +1,273 @@
+import time
 import logging
+import threading
+import Queue
 
-from webmailbox.constants import SUPPORTED_MAIL_PROTOCOLS
-from webmailbox.protocols.pop3 import fetch_pop3_mails
+import tornado.ioloop
+import tornado.escape
+
+from webmailbox.constants import SUPPORTED_MAIL_PROTOCOLS, \
+    FETCH_MAILS_CHANNEL, FETCH_BODIES_CHANNEL, NEW_MAILS_CHANNEL
+from webmailbox.protocols.pop3 import fetch_pop3_mails, \
+    fetch_pop3_mail_bodies
+from webmailbox.protocols.imap import fetch_imap_mails
+from webmailbox.protocols.imap_idle import IdleClient
+from webmailbox.utils import get_header_cache_info
 
 __all__ = [
+    "request_fetch_mails",
+    "fetch_mail_account",
+    "fetch_mail_bodies",
     "fetch_mails",
+    "FetchEngine",
+    "IdleEngine",
 ]
 
-def fetch_mails(db, fs, mq, max_mail_size):
-    channel = "mail_accounts:fetch_mails"
-    fetching = True
-    while fetching:
-        mail_account_id = mq.get_message(channel)
-        if not mail_account_id:
-            fetching = False
+def request_fetch_mails(mq, mail_account, fetch_time_interval=0):
+    """ queue a mail account for fetching
+
+    Nothing is queued if the mail account was fetched less than
+    ``fetch_time_interval`` seconds ago or is already waiting in the queue.
+    """
+    update_at = mail_account.get("update_at") or 0
+    if time.time() - update_at < fetch_time_interval:
+        return False
+    mq.send_message(FETCH_MAILS_CHANNEL, str(mail_account["_id"]),
+                    unique=True)
+    return True
+
+_fetching_mail_account_ids = set()
+_fetching_lock = threading.Lock()
+
+def _lock_mail_account(mail_account_id):
+    """ one mail account is fetched by only one worker at the same time """
+    _fetching_lock.acquire()
+    try:
+        if mail_account_id in _fetching_mail_account_ids:
+            logging.info("mail account %s is being fetched..." % \
+                mail_account_id)
+            return False
+        _fetching_mail_account_ids.add(mail_account_id)
+        return True
+    finally:
+        _fetching_lock.release()
+
+def _unlock_mail_account(mail_account_id):
+    _fetching_lock.acquire()
+    try:
+        _fetching_mail_account_ids.discard(mail_account_id)
+    finally:
+        _fetching_lock.release()
+
+def _publish_new_mails(db, mq, mail_account_id, mail_ids):
+    # counters are read after the fetch, they include the new mails
+    mail_account = db.get_mail_account(mail_account_id)
+    event = {
+        "user_id": str(mail_account["user_id"]),
+        "mail_account_id": str(mail_account["_id"]),
+        "mail_ids": [str(mail_id) for mail_id in mail_ids],
+        "mail_count": mail_account.get("mail_count", 0),
+        "unseen_count": mail_account.get("unseen_count", 0),
+    }
+    mq.publish(NEW_MAILS_CHANNEL, tornado.escape.json_encode(event))
+
+def fetch_mail_account(db, fs, mail_account_id, max_mail_size,
+                       headers_first=False, mq=None):
+    """ fetch new mails of a mail account
+
+    With ``mq`` the new mails are published to NEW_MAILS_CHANNEL. Returns
+    whether mails with headers only are left for fetch_mail_bodies, stored
+    now or by earlier fetches.
+    """
+    mail_account_id = str(mail_account_id)
+    if not _lock_mail_account(mail_account_id):
+        return False
+    try:
         mail_account = db.get_mail_account(mail_account_id)
         if mail_account:
             protocol = mail_account["protocol"]
             if protocol in SUPPORTED_MAIL_PROTOCOLS:
+                mail_ids, without_body = [], False
                 if protocol == "pop3":
-                    fetch_pop3_mails(db, fs, mail_account, max_mail_size)
-                    # update mail_account update_at
-                    db.update_mail_account(mail_account["_id"])
+                    mail_ids, header_only_count = fetch_pop3_mails(db, fs,
+                        mail_account, max_mail_size, headers_first)
+                    # also those whose bodies were asked for while this
+                    # fetch held the mail account
+                    without_body = header_only_count > 0 or \
+                        bool(list(db.get_mails_without_body(
+                            mail_account["_id"], limit=1)))
+                elif protocol == "imap":
+                    mail_ids = fetch_imap_mails(db, fs, mail_account,
+                                                max_mail_size)
+                # update mail_account update_at
+                db.update_mail_account(mail_account["_id"])
+                if mq is not None and mail_ids:
+                    _publish_new_mails(db, mq, mail_account["_id"], mail_ids)
+                logging.debug("header cache: %(hits)s hits, "
+                              "%(misses)s misses, %(size)s headers" % \
+                              get_header_cache_info())
+                return without_body
             else:
                 logging.warning("Not supported now.")
+        return False
+    finally:
+        _unlock_mail_account(mail_account_id)
+
+def fetch_mail_bodies(db, fs, mail_account_id, mail_ids=None):
+    """ fetch bodies of mails stored with headers only
+
+    Those of ``mail_ids`` are fetched first. Returns whether there are
+    more to fetch.
+    """
+    mail_account_id = str(mail_account_id)
+    if not _lock_mail_account(mail_account_id):
+        # the running fetch requests bodies again when any are missing
+        return False
+    try:
+        mail_account = db.get_mail_account(mail_account_id)
+        if mail_account and mail_account["protocol"] == "pop3":
+            return fetch_pop3_mail_bodies(db, fs, mail_account,
+                                          mail_ids=mail_ids)
+        return False
+    finally:
+        _unlock_mail_account(mail_account_id)
+
+def fetch_mails(db, fs, mq, max_mail_size, batch_size=10, timeout=None):
+    """ fetch queued mail accounts until the queue is empty
+
+    With a ``timeout`` it first waits that long for a message to arrive.
+    """
+    channel = FETCH_MAILS_CHANNEL
+    mail_account_ids = mq.get_messages(channel, batch_size, timeout)
+    while mail_account_ids:
+        for mail_account_id in mail_account_ids:
+            fetch_mail_account(db, fs, mail_account_id, max_mail_size,
+                               mq=mq)
+        mail_account_ids = mq.get_messages(channel, batch_size)
+
+class FetchEngine(object):
+    """ fetch mails of many mail accounts in parallel
+
+    A dispatcher reads mail account ids from the message queue and hands
+    them to a bounded pool of worker threads, so one slow mail server only
+    holds up one worker instead of every other mail account. Requests for
+    new mails are served before requests for bodies of mails stored with
+    headers only.
+    """
+
+    channels = (FETCH_MAILS_CHANNEL, FETCH_BODIES_CHANNEL)
+
+    def __init__(self, db, fs, mq, max_mail_size, concurrency=10,
+                 batch_size=None, wait_timeout=5, headers_first=False):
+        self.db = db
+        self.fs = fs
+        self.mq = mq
+        self.max_mail_size = max_mail_size
+        self.concurrency = concurrency
+        self.batch_size = batch_size if batch_size else concurrency
+        self.wait_timeout = wait_timeout
+        self.headers_first = headers_first
+        # blocks the dispatcher while all workers are busy
+        self.tasks = Queue.Queue(concurrency)
+        self.workers = []
+
+    def start(self):
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self._work,
+                                      name="fetch-worker-%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            channel, mail_account_id = self.tasks.get()
+            try:
+                if channel == FETCH_BODIES_CHANNEL:
+                    # "<mail account id>:<mail id>" for a mail opened
+                    mail_account_id, sep, mail_id = \
+                        mail_account_id.partition(":")
+                    more = fetch_mail_bodies(self.db, self.fs,
+                        mail_account_id, [mail_id] if mail_id else None)
+                else:
+                    more = fetch_mail_account(self.db, self.fs,
+                        mail_account_id, self.max_mail_size,
+                        self.headers_first, self.mq)
+                if more:
+                    self.mq.send_message(FETCH_BODIES_CHANNEL,
+                                         mail_account_id, unique=True)
+            except Exception:
+                logging.error("Fetching mail account %s failed" % \
+                    mail_account_id, exc_info=True)
+
+    def dispatch(self):
+        for channel in self.channels:
+            mail_account_ids = self.mq.get_messages(channel, self.batch_size)
+            if mail_account_ids:
+                for mail_account_id in mail_account_ids:
+                    self.tasks.put((channel, mail_account_id))
+                return
+        # blocks in redis while idle instead of polling
+        item = self.mq.get_any_message(self.channels, self.wait_timeout)
+        if item:
+            self.tasks.put(item)
+
+    def run(self):
+        self.start()
+        while True:
+            try:
+                self.dispatch()
+            except Exception:
+                # pops are not retried by the mq, wait for it to come back
+                logging.error("Dispatching fetches failed", exc_info=True)
+                time.sleep(1)
+
+class IdleEngine(object):
+    """ watch the INBOX of every IMAP mail account with IDLE
+
+    One connection per mail account is held on a single IOLoop, and a
+    fetch is queued only when the server reports new messages, so IMAP
+    mail accounts need no polling from the web server. The mail accounts
+    are read again every ``refresh_interval`` seconds to follow added,
+    changed and removed ones.
+    """
+
+    watched_fields = ("address", "password", "host", "port", "use_ssl")
+
+    def __init__(self, db, mq, refresh_interval=60, io_loop=None):
+        self.db = db
+        self.mq = mq
+        self.refresh_interval = refresh_interval
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.clients = {}
+
+    def _on_new_mail(self, mail_account):
+        request_fetch_mails(self.mq, mail_account)
+
+    def _is_changed(self, client, mail_account):
+        for field in self.watched_fields:
+            if client.mail_account.get(field) != mail_account.get(field):
+                return True
+        return False
+
+    def refresh(self):
+        mail_accounts = {}
+        for mail_account in self.db.get_mail_accounts_by_protocol("imap"):
+            mail_accounts[str(mail_account["_id"])] = mail_account
+        for mail_account_id, client in self.clients.items():
+            mail_account = mail_accounts.get(mail_account_id)
+            if mail_account is None or self._is_changed(client, mail_account):
+                client.stop()
+                del self.clients[mail_account_id]
+        for mail_account_id, mail_account in mail_accounts.items():
+            if mail_account_id not in self.clients:
+                client = IdleClient(mail_account, self._on_new_mail,
+                                    self.io_loop)
+                self.clients[mail_account_id] = client
+                client.start()
+
+    def run(self):
+        self.refresh()
+        tornado.ioloop.PeriodicCallback(self.refresh,
+            self.refresh_interval * 1000, self.io_loop).start()
+        self.io_loop.start()
@@ -1,21 +1,26 @@
-import logging
+from webmailbox.connection import connect
 
-def get_db(settings):
+def get_db(settings, pool_size=10):
+    """ a db connection with sockets for ``pool_size`` threads
+
+    Raises if no connection can be made after some retries.
+    """
     dbtype = settings.DB_TYPE
     if dbtype == 'mongodb':
         kwargs = {
             'host': settings.DB_HOST,
             'port': settings.DB_PORT,
             'database': settings.DB_NAME,
+            'pool_size': pool_size,
+            'user_cache_size': settings.USER_CACHE_SIZE,
+            'user_cache_ttl': settings.USER_CACHE_TTL,
         }
         username = settings.DB_USERNAME
         password = settings.DB_PASSWORD
         if username and password:
             kwargs.update({'username': username, 'password': password})
         from mongodb_engine import DBConnection
-        try:
-            return DBConnection(**kwargs)
-        except:
-            logging.error('Can not get connection...')
+        return connect(lambda: DBConnection(**kwargs),
+                       DBConnection.transient_errors)
     else:
-        logging.warning('%s not supported now.' % dbtype)
+        raise ValueError('%s not supported now.' % dbtype)
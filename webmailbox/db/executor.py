@@ -0,0 +1,68 @@
+import sys
+import logging
+import functools
+import threading
+import Queue
+
+import pymongo.cursor
+import tornado.ioloop
+from tornado import stack_context
+
+__all__ = [
+    'AsyncConnection',
+]
+
+class AsyncConnection(object):
+    """ run the methods of a db or fs connection in worker threads
+
+    Every public method of the wrapped connection takes an extra
+    ``callback`` keyword argument, which is called on the IOLoop with the
+    result, so handlers can wait for it with ``tornado.gen.Task`` while the
+    IOLoop keeps serving other requests. Cursors are read into lists in the
+    worker thread, and exceptions are raised again in the handler.
+    """
+
+    def __init__(self, conn, workers=10, io_loop=None):
+        self.conn = conn
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.tasks = Queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self._work,
+                                      name="db-worker-%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self.conn, name)
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            callback = kwargs.pop('callback', None)
+            if callback is not None:
+                callback = stack_context.wrap(
+                    functools.partial(self._deliver, callback))
+            self.tasks.put((method, args, kwargs, callback))
+        return wrapper
+
+    def _deliver(self, callback, result, exc_info):
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        callback(result)
+
+    def _work(self):
+        while True:
+            method, args, kwargs, callback = self.tasks.get()
+            result, exc_info = None, None
+            try:
+                result = method(*args, **kwargs)
+                if isinstance(result, pymongo.cursor.Cursor):
+                    result = list(result)
+            except Exception:
+                exc_info = sys.exc_info()
+                if callback is None:
+                    logging.error('%s failed' % method.__name__,
+                                  exc_info=True)
+            if callback is not None:
+                self.io_loop.add_callback(
+                    functools.partial(callback, result, exc_info))
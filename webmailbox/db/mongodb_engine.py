@@ -3,14 +3,22 @@ import random
 import hashlib
 import logging
 import pymongo
+import pymongo.cursor
+import pymongo.errors
 from pymongo.objectid import ObjectId
 
+from webmailbox.cache import LRUCache
+from webmailbox.connection import ReconnectingConnection, retry_transient
+from webmailbox.utils import encode_mail_cursor, decode_mail_cursor
+
 '''
 db.users <- user
     name                string
     encrypted_password  string
     salt                string
     settings            dict(batch_size, ...)
+    mail_count          int(of all mail accounts)
+    unseen_count        int(of all mail accounts)
 
 db.mail_accounts <- mail_account
     user_id     ObjectId
@@ -23,6 +31,11 @@ db.mail_accounts <- mail_account
     use_ssl     bool
     auto_del    bool
     update_at   timestring
+    mail_count      int
+    unseen_count    int
+    imap_uidvalidity    int, UIDVALIDITY at the last IMAP fetch
+    imap_uidnext        int, UIDNEXT at the last IMAP fetch
+    imap_last_uid       int, highest UID fetched
 
 db.mails <- mail
     mail_account_id     ObjectId
@@ -34,17 +47,73 @@ db.mails <- mail
     is_multipart        bool
     txt                 string
     html                string
-    fs_id               ObjectId(GFS)
+    snippet             string(plain text preview)
+    fs_id               ObjectId(GFS, None until body_fetched)
     attachment_ids      list(GFS ObjectId element)
+    attachments         list(dict(_id, filename, content_type, length))
     seen                bool
     deleted             bool
     folder              string
+    body_fetched        bool(False for mails stored with headers only)
+
+db.search_terms <- search term of a mail, see webmailbox.search
+    user_id             ObjectId
+    term                string
+    mail_id             ObjectId
+    score               int
+
+db.sync_states <- what a POP3 fetch saw of a mail account
+    _id                 ObjectId(of the mail account)
+    stat                list(message count, octets), STAT at the last fetch
 '''
 
 __all__ = [
     'DBConnection',
 ]
 
+ASCENDING = pymongo.ASCENDING
+DESCENDING = pymongo.DESCENDING
+
+# indexes of every collection as (keys, options), see init_indexes
+INDEXES = {
+    'users': [
+        ([('name', ASCENDING)], {'unique': True}),
+    ],
+    'mail_accounts': [
+        ([('user_id', ASCENDING), ('address', ASCENDING)], {}),
+        ([('address', ASCENDING)], {}),
+        ([('protocol', ASCENDING)], {}),
+    ],
+    'mails': [
+        # mail lists, also serves the headers lookup of mails without
+        # unique id as it includes dat
+        ([('mail_account_id', ASCENDING), ('dat', DESCENDING),
+          ('_id', DESCENDING)], {}),
+        ([('mail_account_id', ASCENDING), ('uniqueid', ASCENDING)], {}),
+    ],
+    'search_terms': [
+        ([('user_id', ASCENDING), ('term', ASCENDING),
+          ('score', DESCENDING)], {}),
+        # postings of deleted mails are removed
+        ([('mail_id', ASCENDING)], {}),
+    ],
+}
+
+def _is_collection_scan(plan):
+    """ check an explain() output of any mongodb version for a scan """
+    if isinstance(plan, dict):
+        if str(plan.get('cursor', '')).startswith('BasicCursor') or \
+            plan.get('stage') == 'COLLSCAN':
+            return True
+        return any([_is_collection_scan(v) for v in plan.values()])
+    if isinstance(plan, list):
+        return any([_is_collection_scan(v) for v in plan])
+    return False
+
+# what mail lists show, mail bodies are left in db
+MAIL_LIST_FIELDS = ['mail_account_id', 'frm', 'subject', 'dat', 'seen',
+                    'is_multipart', 'snippet']
+
 def _get_objectid(oid):
     return oid if isinstance(oid, ObjectId) else ObjectId(oid)
 
@@ -52,6 +121,17 @@ def _get_objectids(oids):
     return [oid if isinstance(oid, ObjectId) else ObjectId(oid) \
         for oid in oids]
 
+def _get_mail_cursor_query(token, op):
+    """ query for mails on one side of a mail cursor, ordered by dat, _id """
+    dat, mail_id = decode_mail_cursor(token)
+    mail_id = _get_objectid(mail_id)
+    # the plain bound starts the index walk at the cursor, $or clauses
+    # get no index bounds of their own together with a sort
+    bound = '$lte' if op == '$lt' else '$gte'
+    return {'dat': {bound: dat},
+            '$or': [{'dat': {op: dat}},
+                    {'dat': dat, '_id': {op: mail_id}}]}
+
 def _create_new_salt(obj):
     return '%s%s' % (id(obj), random.random())
 
@@ -59,36 +139,72 @@ def _encrypt_password(password, salt):
     string_to_hash = '%szkc%s' % (password, salt)
     return hashlib.sha1(string_to_hash).hexdigest()
 
-class BaseConnection(object):
-    def __init__(self, host='localhost', port=27017, *args, **kwargs):
+class BaseConnection(ReconnectingConnection):
+    """ a database of a MongoDB server with a pool of ``pool_size`` sockets
+
+    Cursors are read into lists by the retried methods of subclasses, so
+    a lost server is noticed while they can still be tried again.
+    """
+
+    transient_errors = (pymongo.errors.AutoReconnect,)
+
+    def __init__(self, host='localhost', port=27017, database=None,
+                 username=None, password=None, pool_size=10, **kwargs):
+        super(BaseConnection, self).__init__()
         self.host = host
         self.port = port
+        self.database = database
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
         self._conn = None
-        try:
-            self.reconnect()
-        except:
-            logging.error('Cannot connect MongoDB on %s:%s' % \
-                (host, port), exc_info=True)
+        self.db = None
+        self.reconnect()
 
     def close(self):
-        if getattr(self, '__conn', None) is not None:
+        if self._conn is not None:
             self._conn.disconnect()
             self._conn = None
 
     def reconnect(self):
         self.close()
-        self._conn = pymongo.Connection(host=self.host, port=self.port)
+        self._conn = pymongo.Connection(host=self.host, port=self.port,
+                                        max_pool_size=self.pool_size)
+        self.db = self._conn[self.database]
+        if self.username and self.password:
+            if not self.db.authenticate(self.username, self.password):
+                raise Exception('login to MongoDB on %s:%s failed' % \
+                    (self.host, self.port))
+
+    def ping(self):
+        try:
+            self.db.command('ping')
+            return True
+        except Exception:
+            logging.warning('MongoDB on %s:%s does not answer' % \
+                (self.host, self.port), exc_info=True)
+            return False
+
+    def _load(self, result):
+        if isinstance(result, pymongo.cursor.Cursor):
+            return list(result)
+        return result
 
+@retry_transient
 class DBConnection(BaseConnection):
 
+    # writes which would be repeated if they reached the server before
+    # it went away
+    not_retried = ('create_user', 'create_mail_account', 'save_mail',
+                   'update_mail', 'update_mails', 'index_mail',
+                   'clear_deleted_attachment_ids')
+
     def __init__(self, host, port, database, *args, **kwargs):
-        super(DBConnection, self).__init__(host, port, *args, **kwargs)
-        if self._conn is not None:
-            self.db = self._conn[database]
-            if 'username' in kwargs and 'password' in kwargs:
-                if not self.db.authenticate(kwargs['username'], kwargs['password']):
-                    logging.warning('Login failed...')
-                    self.db = None
+        # users looked up by id, dropped again when they are updated
+        self.user_cache = LRUCache(kwargs.pop('user_cache_size', 1000),
+                                   kwargs.pop('user_cache_ttl', 300))
+        super(DBConnection, self).__init__(host, port, database,
+                                           *args, **kwargs)
 
     def get_users(self):
         return self.db.users.find()
@@ -101,12 +217,20 @@ class DBConnection(BaseConnection):
         user['salt'] = salt
         user['encrypted_password'] = _encrypt_password(password, salt)
         user['settings'] = {}
+        user['mail_count'] = 0
+        user['unseen_count'] = 0
         return self.db.users.insert(user)
 
     def get_user(self, user_id=None, **kwargs):
         if user_id:
             user_id = _get_objectid(user_id)
-            return self.db.users.find_one({"_id": user_id})
+            user = self.user_cache.get(user_id)
+            if user is None:
+                user = self.db.users.find_one({"_id": user_id})
+                if user is None:
+                    return
+                self.user_cache.set(user_id, user)
+            return dict(user)
         elif kwargs:
             return self.db.users.find_one(kwargs)
 
@@ -117,8 +241,10 @@ class DBConnection(BaseConnection):
         if user_id:
             user_id = _get_objectid(user_id)
             query.update({'_id': user_id})
+            self.user_cache.delete(user_id)
         elif name:
             query.update({'name': name})
+            self.user_cache.clear()
         if query:
             self.db.users.update(query, {'$set': kwargs}, upsert=False)
 
@@ -138,6 +264,9 @@ class DBConnection(BaseConnection):
         user_id = _get_objectid(user_id)
         return self.db.mail_accounts.find({'user_id': user_id})
 
+    def get_mail_accounts_by_protocol(self, protocol):
+        return self.db.mail_accounts.find({'protocol': protocol})
+
     def create_mail_account(self, mail_account):
         attributes = ('user_id', 'address', 'password', 'nickname',
                       'host', 'port', 'protocol', 'use_ssl', 'auto_del')
@@ -146,6 +275,8 @@ class DBConnection(BaseConnection):
                 raise Exception('missing attribute:' + attr)
         mail_account['user_id'] = _get_objectid(mail_account['user_id'])
         mail_account['update_at'] = time.time()
+        mail_account['mail_count'] = 0
+        mail_account['unseen_count'] = 0
         return self.db.mail_accounts.insert(mail_account)
 
     def get_mail_account(self, mail_account_id=None, **kwargs):
@@ -168,8 +299,20 @@ class DBConnection(BaseConnection):
             {'$set': kwargs}, upsert=False)
 
     def get_mails(self, mail_account_id=None, mail_account_ids=None,
-                  skip=0, limit=10):
-        extra = None
+                  before=None, after=None, limit=10, fields=None,
+                  folder=None):
+        """ page through mails newest first, deleted ones left out
+
+        ``before`` and ``after`` are cursors returned with another page.
+        Returns ``(mails, older, newer)``, the cursors of the pages around
+        this one, or None where there is no such page. Every page costs
+        the same index walk however deep it is. Mails have ``fields`` only,
+        MAIL_LIST_FIELDS by default, and are those of ``folder`` if given.
+        """
+        if fields is None:
+            fields = MAIL_LIST_FIELDS
+        elif 'dat' not in fields:
+            fields = list(fields) + ['dat']    # for the cursors
         query = {}
         if mail_account_id:
             mail_account_id = _get_objectid(mail_account_id)
@@ -177,17 +320,49 @@ class DBConnection(BaseConnection):
         elif mail_account_ids:
             mail_account_ids = _get_objectids(mail_account_ids)
             query.update({'mail_account_id': {'$in': mail_account_ids}})
-        if query:
-            mails = self.db.mails.find(query,
-                                       sort=[('dat', pymongo.DESCENDING)],
-                                       skip=skip, limit=limit+1)
-            mails = list(mails)
-            if len(mails) > limit:
-                extra = mails[-1]
-                mails = mails[:limit]
+        if not query:
+            return [], None, None
+        query['deleted'] = False
+        if folder is not None:
+            query['folder'] = folder
+
+        page_query = dict(query)
+        if after:
+            page_query.update(_get_mail_cursor_query(after, '$gt'))
+            sort = [('dat', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
         else:
-            mails = []
-        return mails, extra
+            if before:
+                page_query.update(_get_mail_cursor_query(before, '$lt'))
+            sort = [('dat', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+        mails = list(self.db.mails.find(page_query, fields=fields,
+                                        sort=sort, limit=limit))
+        if after:
+            mails.reverse()
+        if not mails:
+            return mails, None, None
+
+        older = encode_mail_cursor(mails[-1])
+        newer = encode_mail_cursor(mails[0])
+        if not after and not self._has_mails(query, older, '$lt'):
+            older = None
+        if not before and not (after and \
+            self._has_mails(query, newer, '$gt')):
+            newer = None
+        return mails, older, newer
+
+    def get_folders(self, mail_account_ids):
+        """ names of the folders holding mails of ``mail_account_ids`` """
+        mail_account_ids = _get_objectids(mail_account_ids)
+        if not mail_account_ids:
+            return []
+        return sorted(self.db.mails.find(
+            {'mail_account_id': {'$in': mail_account_ids}, 'deleted': False}
+            ).distinct('folder'))
+
+    def _has_mails(self, query, token, op):
+        query = dict(query)
+        query.update(_get_mail_cursor_query(token, op))
+        return self.db.mails.find_one(query, fields=['_id']) is not None
 
     def save_mail(self, mail):
         attributes = ('mail_account_id', 'uniqueid', 'frm', 'to', 'subject',
@@ -197,36 +372,334 @@ class DBConnection(BaseConnection):
             if attr not in mail:
                 raise Exception('missing attribute:' + attr)
         mail['mail_account_id'] = _get_objectid(mail['mail_account_id'])
-        mail['fs_id'] = _get_objectid(mail['fs_id'])
+        if mail['fs_id'] is not None:
+            mail['fs_id'] = _get_objectid(mail['fs_id'])
         mail['attachment_ids'] = _get_objectids(mail['attachment_ids'])
+        mail.setdefault('body_fetched', True)
         mail['seen'] = False
         mail['deleted'] = False
-        return self.db.mails.insert(mail)
+        mail_id = self.db.mails.insert(mail)
+        self._inc_mail_counters(mail['mail_account_id'], 1, 1)
+        return mail_id
+
+    def _inc_mail_counters(self, mail_account_id, mail_count, unseen_count):
+        """ add to the mail counters of a mail account and its user """
+        inc = {'mail_count': mail_count, 'unseen_count': unseen_count}
+        mail_account = self.db.mail_accounts.find_and_modify(
+            {'_id': mail_account_id}, {'$inc': inc}, fields=['user_id'])
+        if mail_account:
+            self.db.users.update({'_id': mail_account['user_id']},
+                                 {'$inc': inc})
+            self.user_cache.delete(mail_account['user_id'])
+
+    def get_mails_without_body(self, mail_account_id, limit=100):
+        """ mails stored with headers only, newest first """
+        mail_account_id = _get_objectid(mail_account_id)
+        return self.db.mails.find({'mail_account_id': mail_account_id,
+                                   'body_fetched': False, 'deleted': False},
+                                  fields=['uniqueid', 'frm', 'to', 'subject'],
+                                  sort=[('dat', DESCENDING)], limit=limit)
+
+    def save_mail_body(self, mail_id, body):
+        """ set the body fields of a mail stored with headers only """
+        mail_id = _get_objectid(mail_id)
+        if body.get('fs_id') is not None:
+            body['fs_id'] = _get_objectid(body['fs_id'])
+        if 'attachment_ids' in body:
+            body['attachment_ids'] = _get_objectids(body['attachment_ids'])
+        self.db.mails.update({'_id': mail_id}, {'$set': body}, upsert=False)
 
     def get_mail(self, mail_id=None, **kwargs):
         if mail_id:
             mail_id = _get_objectid(mail_id)
             return self.db.mails.find_one({'_id': mail_id})
         elif kwargs:
-            if 'attachment_id' in kwargs:
-                attachment_id = _get_objectid(kwargs.pop('attachment_id'))
-                kwargs.update({'attachment_ids': attachment_id})
             return self.db.mails.find_one(kwargs)
 
+    def get_mails_by_ids(self, mail_ids, fields=None, deleted=None):
+        """ mails of ``mail_ids`` in their order with one query
+
+        Missing mails are left out, ``fields`` as for find. Deleted mails
+        are left out too with ``deleted=False``.
+        """
+        mail_ids = _get_objectids(mail_ids)
+        if not mail_ids:
+            return []
+        query = {'_id': {'$in': mail_ids}}
+        if deleted is not None:
+            query['deleted'] = deleted
+        mails = {}
+        for mail in self.db.mails.find(query, fields=fields):
+            mails[mail['_id']] = mail
+        return [mails[mail_id] for mail_id in mail_ids if mail_id in mails]
+
+    def get_mail_uniqueids(self, mail_account_id, uniqueids):
+        """ return the subset of ``uniqueids`` already stored """
+        uniqueids = list(uniqueids)
+        if not uniqueids:
+            return set()
+        mail_account_id = _get_objectid(mail_account_id)
+        mails = self.db.mails.find({'mail_account_id': mail_account_id,
+                                    'uniqueid': {'$in': uniqueids}},
+                                   fields=['uniqueid'])
+        return set([mail['uniqueid'] for mail in mails])
+
+    def migrate_pop3_uniqueids(self):
+        """ strip unique ids stored as whole UIDL responses to the id
+
+        Mails used to keep the ``+OK n id`` line of UIDL, they would all be
+        fetched again once fetches compare bare ids. Returns how many mails
+        changed.
+        """
+        count = 0
+        for mail in self.db.mails.find({'uniqueid': {'$regex': r'^\+OK '}},
+                                       fields=['uniqueid']):
+            self.db.mails.update({'_id': mail['_id']},
+                {'$set': {'uniqueid': mail['uniqueid'].split()[-1]}})
+            count += 1
+        return count
+
+    def get_sync_state(self, mail_account_id):
+        mail_account_id = _get_objectid(mail_account_id)
+        return self.db.sync_states.find_one({'_id': mail_account_id}) or {}
+
+    def set_sync_state(self, mail_account_id, **kwargs):
+        mail_account_id = _get_objectid(mail_account_id)
+        self.db.sync_states.update({'_id': mail_account_id},
+            {'$set': kwargs}, upsert=True)
+
     def update_mail(self, mail_id, **kwargs):
         mail_id = _get_objectid(mail_id)
-        self.db.mails.update({'_id': mail_id},
-            {'$set': kwargs}, upsert=False)
+        if 'seen' in kwargs:
+            # only a real change of seen moves the unseen counters
+            seen = kwargs.pop('seen')
+            mail = self.db.mails.find_and_modify(
+                {'_id': mail_id, 'seen': not seen}, {'$set': {'seen': seen}},
+                fields=['mail_account_id'])
+            if mail:
+                self._inc_mail_counters(mail['mail_account_id'], 0,
+                                        -1 if seen else 1)
+        if kwargs:
+            self.db.mails.update({'_id': mail_id},
+                {'$set': kwargs}, upsert=False)
+
+    def update_mails(self, mail_ids, mail_account_ids=None, seen=None,
+                     deleted=None, folder=None):
+        """ change the state of many mails with a multi update per account
+
+        Only mails of ``mail_account_ids`` are changed if given, deleted
+        mails are left as they are. Only mails really changed move the
+        counters, deleting mails is not undone. Returns how many mails
+        changed.
+        """
+        query = {'_id': {'$in': _get_objectids(mail_ids)},
+                 'deleted': False}
+        if mail_account_ids is not None:
+            query['mail_account_id'] = {
+                '$in': _get_objectids(mail_account_ids)}
+        account_mail_ids = {}
+        for mail in self.db.mails.find(query, fields=['mail_account_id']):
+            account_mail_ids.setdefault(mail['mail_account_id'],
+                                        []).append(mail['_id'])
+        changed = 0
+        for mail_account_id, ids in account_mail_ids.items():
+            query = {'_id': {'$in': ids}, 'deleted': False}
+            if deleted:
+                # unseen ones first to know how many unseen are gone
+                unseen = self._update_mails(dict(query, seen=False),
+                                            {'deleted': True})
+                count = unseen + self._update_mails(query, {'deleted': True})
+                if count:
+                    self._inc_mail_counters(mail_account_id, -count, -unseen)
+                    # deleted mails are not searched for anymore
+                    self.db.search_terms.remove({'mail_id': {'$in': ids}})
+                changed += count
+                continue
+            if seen is not None:
+                count = self._update_mails(dict(query, seen=not seen),
+                                           {'seen': seen})
+                if count:
+                    self._inc_mail_counters(mail_account_id, 0,
+                                            -count if seen else count)
+                changed += count
+            if folder is not None:
+                changed += self._update_mails(
+                    dict(query, folder={'$ne': folder}), {'folder': folder})
+        return changed
+
+    def clear_deleted_attachment_ids(self, mail_ids, mail_account_ids=None):
+        """ take the attachment ids of deleted mails, once for every mail
+
+        Only mails of ``mail_account_ids`` are taken if given. Returns the
+        ids the mails held, for the fs to release them, and leaves the mails
+        without attachments.
+        """
+        query = {'_id': {'$in': _get_objectids(mail_ids)}, 'deleted': True,
+                 'attachment_ids': {'$ne': []}}
+        if mail_account_ids is not None:
+            query['mail_account_id'] = {
+                '$in': _get_objectids(mail_account_ids)}
+        attachment_ids = []
+        while True:
+            # one mail a time so each one is taken by a single caller
+            mail = self.db.mails.find_and_modify(query,
+                {'$set': {'attachment_ids': []}}, fields=['attachment_ids'])
+            if not mail:
+                return attachment_ids
+            attachment_ids.extend(mail['attachment_ids'])
+
+    def _update_mails(self, query, changes):
+        result = self.db.mails.update(query, {'$set': changes},
+                                      multi=True, safe=True)
+        return result['n']
+
+    def repair_mail_counters(self):
+        """ recount the mail counters of all mail accounts and users """
+        user_counters = {}
+        for mail_account in self.db.mail_accounts.find(fields=['user_id']):
+            query = {'mail_account_id': mail_account['_id'], 'deleted': False}
+            mail_count = self.db.mails.find(query).count()
+            query['seen'] = False
+            unseen_count = self.db.mails.find(query).count()
+            self.db.mail_accounts.update({'_id': mail_account['_id']},
+                {'$set': {'mail_count': mail_count,
+                          'unseen_count': unseen_count}})
+            counters = user_counters.setdefault(mail_account['user_id'],
+                                                [0, 0])
+            counters[0] += mail_count
+            counters[1] += unseen_count
+        for user in self.db.users.find(fields=['_id']):
+            mail_count, unseen_count = user_counters.get(user['_id'], (0, 0))
+            self.db.users.update({'_id': user['_id']},
+                {'$set': {'mail_count': mail_count,
+                          'unseen_count': unseen_count}})
+            self.user_cache.delete(user['_id'])
+
+    def index_mail(self, user_id, mail_id, terms):
+        """ add a mail to the search index of its user
+
+        ``terms`` maps search terms to scores, see webmailbox.search.
+        """
+        user_id = _get_objectid(user_id)
+        mail_id = _get_objectid(mail_id)
+        search_terms = []
+        for term, score in terms.items():
+            search_terms.append({'user_id': user_id, 'term': term,
+                                 'mail_id': mail_id, 'score': score})
+        if search_terms:
+            self.db.search_terms.insert(search_terms)
+
+    def search_mails(self, user_id, terms, skip=0, limit=10,
+                     max_postings=5000):
+        """ mails of a user with all ``terms``, best matches first
+
+        Postings of the rarest term are read first, up to the
+        ``max_postings`` best scored, and those of the other terms only for
+        the mails found so far, so common terms cost no more than rare
+        ones. Returns ``(mails, total, truncated)``, mails with
+        MAIL_LIST_FIELDS only; ``truncated`` tells the rarest term was
+        found in more mails than were looked at, so mails may be missing.
+        """
+        user_id = _get_objectid(user_id)
+        counts = []
+        for term in set(terms):
+            count = self.db.search_terms.find(
+                {'user_id': user_id, 'term': term}).count()
+            if not count:
+                return [], 0, False
+            counts.append((count, term))
+        if not counts:
+            return [], 0, False
+        counts.sort()
+        count, term = counts[0]
+        truncated = count > max_postings
+        scores = {}
+        postings = self.db.search_terms.find(
+            {'user_id': user_id, 'term': term},
+            fields=['mail_id', 'score'], sort=[('score', DESCENDING)],
+            limit=max_postings)
+        for posting in postings:
+            scores[posting['mail_id']] = posting['score']
+        for count, term in counts[1:]:
+            term_scores = {}
+            postings = self.db.search_terms.find(
+                {'user_id': user_id, 'term': term,
+                 'mail_id': {'$in': scores.keys()}},
+                fields=['mail_id', 'score'])
+            for posting in postings:
+                term_scores[posting['mail_id']] = posting['score']
+            for mail_id in scores.keys():
+                if mail_id in term_scores:
+                    scores[mail_id] += term_scores[mail_id]
+                else:
+                    del scores[mail_id]
+            if not scores:
+                return [], 0, truncated
+        # postings of mails deleted before theirs were removed with them
+        for mail in self.db.mails.find({'_id': {'$in': scores.keys()},
+                                        'deleted': True}, fields=['_id']):
+            del scores[mail['_id']]
+        # newer mails first for equal scores, object ids grow with time
+        ranked = sorted(scores.items(),
+                        key=lambda item: (item[1], item[0]), reverse=True)
+        mail_ids = [mail_id for mail_id, score in ranked[skip:skip + limit]]
+        mails = self.get_mails_by_ids(mail_ids, MAIL_LIST_FIELDS,
+                                      deleted=False)
+        return mails, len(ranked), truncated
 
     def init_indexes(self):
-        self.db.users.ensure_index([
-            ('name', pymongo.ASCENDING),
-        ])
-        self.db.mail_accounts.ensure_index([
-            ('user_id', pymongo.ASCENDING),
-            ('address', pymongo.ASCENDING),
-        ])
-        self.db.mails.ensure_index([
-            ('mail_account_id', pymongo.ASCENDING)
-            ('dat', pymongo.DESCENDING)
-        ])
+        """ create the indexes in INDEXES, existing ones are kept """
+        for collection, indexes in INDEXES.items():
+            for keys, options in indexes:
+                self.db[collection].ensure_index(keys, **options)
+
+    def _get_query_shapes(self):
+        """ a cursor for each kind of query issued by this class """
+        oid = ObjectId()
+        mail_cursor = encode_mail_cursor({'dat': 0.0, '_id': oid})
+        mails_page = [('dat', DESCENDING), ('_id', DESCENDING)]
+        page_query = {'mail_account_id': {'$in': [oid]}, 'deleted': False}
+        page_query.update(_get_mail_cursor_query(mail_cursor, '$lt'))
+        return [
+            ('users by name',
+             self.db.users.find({'name': ''})),
+            ('mail accounts of user',
+             self.db.mail_accounts.find({'user_id': oid})),
+            ('mail accounts by address',
+             self.db.mail_accounts.find({'address': ''})),
+            ('mail accounts by protocol',
+             self.db.mail_accounts.find({'protocol': ''})),
+            ('mails page',
+             self.db.mails.find({'mail_account_id': {'$in': [oid]},
+                                 'deleted': False}, sort=mails_page)),
+            ('mails page after cursor',
+             self.db.mails.find(page_query, sort=mails_page)),
+            ('mails by unique ids',
+             self.db.mails.find({'mail_account_id': oid,
+                                 'uniqueid': {'$in': ['']}})),
+            ('search terms of user',
+             self.db.search_terms.find({'user_id': oid, 'term': ''},
+                                       sort=[('score', DESCENDING)])),
+            ('search terms of mail',
+             self.db.search_terms.find({'mail_id': {'$in': [oid]}})),
+            ('search terms of mails',
+             self.db.search_terms.find({'user_id': oid, 'term': '',
+                                        'mail_id': {'$in': [oid]}})),
+            ('mails by ids',
+             self.db.mails.find({'_id': {'$in': [oid]}})),
+            ('mails without body',
+             self.db.mails.find({'mail_account_id': oid,
+                                 'body_fetched': False, 'deleted': False},
+                                sort=[('dat', DESCENDING)])),
+            ('mails by headers',
+             self.db.mails.find({'mail_account_id': oid, 'frm': '',
+                                 'to': '', 'subject': '', 'dat': 0.0})),
+        ]
+
+    def check_indexes(self):
+        """ explain every kind of query, return those scanning collections """
+        scans = []
+        for name, cursor in self._get_query_shapes():
+            if _is_collection_scan(cursor.explain()):
+                scans.append(name)
+        return scans
@@ -1,21 +1,33 @@
-import logging
+import os.path
 
-def get_fs(settings):
+from webmailbox.connection import connect
+
+def get_fs(settings, pool_size=10):
+    """ a fs connection with sockets for ``pool_size`` threads
+
+    Raises if no connection can be made after some retries.
+    """
     fstype = settings.FS_TYPE
     if fstype == 'mongodb':
         kwargs = {
             'host': settings.FS_HOST,
             'port': settings.FS_PORT,
             'database': settings.FS_NAME,
+            'pool_size': pool_size,
         }
         username = settings.FS_USERNAME
         password = settings.FS_PASSWORD
         if username and password:
             kwargs.update({'username': username, 'password': password})
         from mongodb_engine import FSConnection
-        try:
-            return FSConnection(**kwargs)
-        except:
-            logging.error('Can not get connection...')
+        return connect(lambda: FSConnection(**kwargs),
+                       FSConnection.transient_errors)
+    elif fstype == 'local':
+        from local_engine import FSConnection
+        # relative to the settings, so every process uses the same files
+        # whatever directory it is started in
+        path = os.path.join(os.path.dirname(os.path.abspath(
+            settings.__file__)), settings.FS_PATH)
+        return FSConnection(path)
     else:
-        logging.warning("%s not supported now." % fstype)
+        raise ValueError("%s not supported now." % fstype)
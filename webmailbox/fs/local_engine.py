@@ -0,0 +1,278 @@
+import os
+import mmap
+import time
+import fcntl
+import hashlib
+import datetime
+import tempfile
+import threading
+
+import tornado.escape
+from pymongo.objectid import ObjectId
+
+__all__ = [
+    'FSConnection',
+]
+
+CHUNK_SIZE = 256 * 1024     # bytes handed out per read by file servers
+
+def _get_objectid(oid):
+    return oid if isinstance(oid, ObjectId) else ObjectId(oid)
+
+def _makedirs(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:     # made by another thread meanwhile
+            if not os.path.isdir(directory):
+                raise
+
+def _read(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _write_atomic(path, data):
+    """ replace ``path`` by ``data``, readers see the old or the new one """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(temp_path, path)
+
+class LocalFile(object):
+    """ a stored file read through a memory map
+
+    Has the attributes of a GridFS file used by the handlers, reads return
+    slices of the map without going through python file buffers.
+    """
+
+    def __init__(self, path, meta):
+        self._id = ObjectId(meta['_id'])
+        self.filename = meta.get('filename')
+        self.content_type = meta.get('content_type')
+        self.length = meta['length']
+        self.md5 = meta['md5']
+        self.upload_date = datetime.datetime.utcfromtimestamp(
+            meta['upload_date'])
+        self.chunk_size = CHUNK_SIZE
+        self._position = 0
+        self._map = None
+        if self.length:
+            f = open(path, 'rb')
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()   # the map keeps the file open itself
+
+    def read(self, size=-1):
+        if self._map is None:
+            return ''
+        if size < 0:
+            size = self.length - self._position
+        data = self._map[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._position
+        elif whence == os.SEEK_END:
+            pos += self.length
+        self._position = min(max(pos, 0), self.length)
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+class LocalFileWriter(object):
+    """ a new file written in chunks, stored by ``close()``
+
+    The data goes to a temporary file next to its final place and is
+    renamed there, with its metadata written last, so a file is either
+    complete or missing. ``filename`` and ``content_type`` may be set until
+    it is closed.
+    """
+
+    def __init__(self, conn, **kwargs):
+        self._conn = conn
+        self._id = kwargs.pop('_id', None) or ObjectId()
+        self.filename = kwargs.pop('filename', None)
+        self.content_type = kwargs.pop('content_type', None)
+        self._extra = kwargs
+        self._path = conn._get_path(self._id)
+        self._md5 = hashlib.md5()
+        self._length = 0
+        self._closed = False
+        directory = os.path.dirname(self._path)
+        _makedirs(directory)
+        fd, self._temp_path = tempfile.mkstemp(dir=directory)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self._md5.update(data)
+        self._length += len(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.rename(self._temp_path, self._path)
+        meta = dict(self._extra)
+        meta.update({
+            '_id': str(self._id),
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'length': self._length,
+            'md5': self._md5.hexdigest(),
+            'upload_date': time.time(),
+        })
+        self._conn._write_meta(self._id, meta)
+
+class FSConnection(object):
+    """ files in a directory tree on the local disk
+
+    Files are kept as ``<root>/<xx>/<yy>/<id>`` with their metadata in
+    ``<id>.meta``, where ``xxyy`` starts the md5 of the id, so directories
+    stay small. Attachments are addressed by the sha1 of their data under
+    ``<root>/sha1/`` and carry a reference count like in GridFS. For one
+    server only, as all processes must see the same disk.
+    """
+
+    def __init__(self, root, **kwargs):
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+        self.init_indexes()
+
+    def _get_path(self, file_id):
+        file_id = str(file_id)
+        digest = hashlib.md5(file_id).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], file_id)
+
+    def _get_sha1_path(self, sha1):
+        return os.path.join(self.root, 'sha1', sha1[:2], sha1)
+
+    def _read_meta(self, file_id):
+        try:
+            return tornado.escape.json_decode(
+                _read(self._get_path(file_id) + '.meta'))
+        except IOError:
+            return None
+
+    def _write_meta(self, file_id, meta):
+        _write_atomic(self._get_path(file_id) + '.meta',
+                      tornado.escape.json_encode(meta))
+
+    def _acquire(self):
+        """ lock reference counts against threads and other processes """
+        self._lock.acquire()
+        self._lock_file = open(os.path.join(self.root, '.lock'), 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _release(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock.release()
+
+    def get_file(self, file_id):
+        file_id = _get_objectid(file_id)
+        meta = self._read_meta(file_id)
+        if meta is None:
+            raise IOError('no file with id %s' % file_id)
+        return LocalFile(self._get_path(file_id), meta)
+
+    def read_file(self, stored_file, size=-1):
+        return stored_file.read(size)
+
+    def insert_file(self, insert_file):
+        kwargs = {}
+        for k in insert_file:
+            if k != 'data':
+                kwargs[k] = insert_file[k]
+        f = self.new_file(**kwargs)
+        f.write(insert_file['data'])
+        f.close()
+        return f._id
+
+    def insert_attachment(self, attachment):
+        """ store attachment data once per content
+
+        See the GridFS engine, the reference count is kept in the metadata
+        of the file.
+        """
+        file_data = attachment['data']
+        sha1 = hashlib.sha1(file_data).hexdigest()
+        sha1_path = self._get_sha1_path(sha1)
+        self._acquire()
+        try:
+            if os.path.exists(sha1_path):
+                file_id = _read(sha1_path)
+                meta = self._read_meta(file_id)
+                if meta is not None:
+                    meta['refcount'] += 1
+                    self._write_meta(file_id, meta)
+                    return ObjectId(file_id)
+            kwargs = {}
+            for k in attachment:
+                if k != 'data':
+                    kwargs[k] = attachment[k]
+            f = self.new_file(sha1=sha1, refcount=1, **kwargs)
+            f.write(file_data)
+            f.close()
+            _makedirs(os.path.dirname(sha1_path))
+            _write_atomic(sha1_path, str(f._id))
+            return f._id
+        finally:
+            self._release()
+
+    def release_attachment(self, file_id):
+        """ drop one reference, deleting the data with the last one """
+        file_id = _get_objectid(file_id)
+        self._acquire()
+        try:
+            meta = self._read_meta(file_id)
+            if meta is None:
+                return
+            meta['refcount'] -= 1
+            if meta['refcount'] > 0:
+                self._write_meta(file_id, meta)
+                return
+            sha1_path = self._get_sha1_path(meta['sha1'])
+            if os.path.exists(sha1_path):
+                os.remove(sha1_path)
+            self.delete_file(file_id)
+        finally:
+            self._release()
+
+    def new_file(self, **kwargs):
+        """ open a new file to be written in chunks, ``close()`` saves it """
+        return LocalFileWriter(self, **kwargs)
+
+    def delete_file(self, file_id):
+        path = self._get_path(_get_objectid(file_id))
+        # without metadata the file is gone for readers already
+        for p in (path + '.meta', path):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def init_indexes(self):
+        """ make the directories the others are made in """
+        _makedirs(os.path.join(self.root, 'sha1'))
+
+    def check_indexes(self):
+        return []
+
+    def ping(self):
+        return os.access(self.root, os.W_OK)
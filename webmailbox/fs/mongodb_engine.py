@@ -1,8 +1,11 @@
-import logging
+import hashlib
 import gridfs
+import pymongo
+import pymongo.errors
 from pymongo.objectid import ObjectId
 
-from webmailbox.db.mongodb_engine import BaseConnection
+from webmailbox.db.mongodb_engine import BaseConnection, _is_collection_scan
+from webmailbox.connection import retry_transient
 
 __all__ = [
     'FSConnection',
@@ -15,23 +18,26 @@ def _get_objectids(oids):
     return [oid if isinstance(oid, ObjectId) else ObjectId(oid) \
         for oid in oids]
 
+@retry_transient
 class FSConnection(BaseConnection):
 
-    def __init__(self, host, port, database, *args, **kwargs):
-        super(FSConnection, self).__init__(host, port, *args, **kwargs)
-        if self._conn is not None:
-            self.db = self._conn[database]
-            self.fs = gridfs.GridFS(self.db)
-            if 'username' in kwargs and 'password' in kwargs:
-                if not self.db.authenticate(kwargs['username'], kwargs['password']):
-                    logging.warning('Login failed...')
-                    self.db = None
-                    self.fs = None
+    # writes which would be repeated if they reached the server before
+    # it went away, and reads moving on in a file
+    not_retried = ('insert_file', 'insert_attachment', 'release_attachment',
+                   'read_file')
+
+    def reconnect(self):
+        super(FSConnection, self).reconnect()
+        self.fs = gridfs.GridFS(self.db)
 
     def get_file(self, file_id):
         file_id = _get_objectid(file_id)
         return self.fs.get(file_id)
 
+    def read_file(self, stored_file, size=-1):
+        """ read from a file got with get_file, in a worker thread """
+        return stored_file.read(size)
+
     def insert_file(self, insert_file):
         file_data = insert_file['data']
         kwargs = {}
@@ -39,3 +45,64 @@ class FSConnection(BaseConnection):
             if k != 'data':
                 kwargs[k] = insert_file[k]
         return self.fs.put(file_data, **kwargs)
+
+    def insert_attachment(self, attachment):
+        """ store attachment data once per content
+
+        Files are addressed by the sha1 of their data and carry a reference
+        count, so the same attachment in many mails is written only once.
+        The returned file keeps the filename and content type it was first
+        stored with; callers keep their own per mail names.
+        """
+        file_data = attachment['data']
+        sha1 = hashlib.sha1(file_data).hexdigest()
+        files = self.db.fs.files
+        kwargs = {}
+        for k in attachment:
+            if k != 'data':
+                kwargs[k] = attachment[k]
+        while True:
+            stored = files.find_and_modify({'sha1': sha1},
+                {'$inc': {'refcount': 1}}, fields=['_id'])
+            if stored:
+                return stored['_id']
+            # not stored yet, or released by its last mail meanwhile
+            file_id = ObjectId()
+            try:
+                return self.fs.put(file_data, _id=file_id, sha1=sha1,
+                                   refcount=1, **kwargs)
+            except pymongo.errors.DuplicateKeyError:
+                # stored by another fetcher meanwhile, sha1 is unique
+                self.db.fs.chunks.remove({'files_id': file_id})
+
+    def release_attachment(self, file_id):
+        """ drop one reference, deleting the data with the last one
+
+        The file is removed only while no reference was added again, an
+        insert_attachment finding it gone stores the data once more.
+        """
+        file_id = _get_objectid(file_id)
+        files = self.db.fs.files
+        files.update({'_id': file_id}, {'$inc': {'refcount': -1}})
+        if files.find_and_modify({'_id': file_id, 'refcount': {'$lte': 0}},
+                                 remove=True, fields=['_id']):
+            self.db.fs.chunks.remove({'files_id': file_id})
+
+    def new_file(self, **kwargs):
+        """ open a new file to be written in chunks, ``close()`` saves it """
+        return self.fs.new_file(**kwargs)
+
+    def delete_file(self, file_id):
+        file_id = _get_objectid(file_id)
+        self.fs.delete(file_id)
+
+    def init_indexes(self):
+        # only attachments have a sha1, other files are left out
+        self.db.fs.files.ensure_index([('sha1', pymongo.ASCENDING)],
+                                      unique=True, sparse=True)
+
+    def check_indexes(self):
+        cursor = self.db.fs.files.find({'sha1': ''})
+        if _is_collection_scan(cursor.explain()):
+            return ['files by sha1']
+        return []
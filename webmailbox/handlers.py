@@ -1,28 +1,108 @@
+import re
+import time
+import httplib
+import datetime
+import email.utils
 import functools
 
 import tornado.auth
+import tornado.ioloop
 import tornado.web
+import tornado.gen
 import tornado.httpclient
 import tornado.escape
+from pymongo.objectid import ObjectId
 
-from webmailbox.constants import SUPPORTED_MAIL_PROTOCOLS
+from webmailbox.constants import SUPPORTED_MAIL_PROTOCOLS, \
+    FETCH_BODIES_CHANNEL
 from webmailbox.validates import validate_username, validate_password, \
     validate_email
 from webmailbox.protocols.pop3 import get_authenticated_pop3
+from webmailbox.protocols.imap import get_authenticated_imap
+from webmailbox.core import request_fetch_mails
+from webmailbox.db.mongodb_engine import MAIL_LIST_FIELDS
+from webmailbox.utils import decode_mail_cursor
+from webmailbox.search import tokenize
 
 __all__ = ["urls_mapping"]
 
-def authenticated(method):
-    """Decorate with this method to restrict to authenticated user."""
+UPDATES_TIMEOUT = 50    # seconds a long poll for new mails is held
+# fields of mails a client may ask the api for, MAIL_LIST_FIELDS are also
+# sent by /mailbox/updates/ and by default in api lists
+API_MAIL_FIELDS = MAIL_LIST_FIELDS + ["to", "txt", "html", "attachments",
+                                      "body_fetched", "folder"]
+API_MAX_LIMIT = 100     # mails of an api list page at most
+API_MAX_BATCH = 50      # mails of an api batch at most
+
+_objectid_re = re.compile(r'^[0-9a-f]{24}$')
+_local_path_re = re.compile(r'^/(?![/\\])')
+
+def _load_user_first(method, on_anonymous=None):
+    """ run ``method`` once current_user has been read with async_db
+
+    Methods not made asynchronous are finished after they return, like
+    tornado does. Without a user ``on_anonymous`` is called instead if
+    given.
+    """
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        if not self.current_user:
-            self.redirect(self.settings["login_url"])
-            return
-        else:
-            return method(self, *args, **kwargs)
+        asynchronous = not self._auto_finish
+        self._auto_finish = False
+        def on_user():
+            if on_anonymous is not None and not self.current_user:
+                on_anonymous(self)
+                return
+            method(self, *args, **kwargs)
+            if not asynchronous and not self._finished:
+                self.finish()
+        self.load_current_user(on_user)
     return wrapper
 
+def authenticated(method):
+    """Decorate with this method to restrict to authenticated user."""
+    def on_anonymous(self):
+        self.redirect(self.settings["login_url"])
+    return _load_user_first(method, on_anonymous)
+
+def api_authenticated(method):
+    """Like authenticated, but answers 403 with a json error for api."""
+    def on_anonymous(self):
+        raise tornado.web.HTTPError(403, "login required.")
+    return _load_user_first(method, on_anonymous)
+
+def with_current_user(method):
+    """Read current_user for a method which does not require it."""
+    return _load_user_first(method)
+
+def _get_json(value):
+    """ a mail or part of it with object ids as strings """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, dict):
+        return dict([(k, _get_json(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return [_get_json(v) for v in value]
+    return value
+
+def _parse_range(range_header, length):
+    """ parse a single 'bytes=start-end' range to a [start, end) slice
+
+    Returns None for ranges that are not understood, the whole file is
+    sent for those.
+    """
+    unit, sep, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec or "-" not in spec:
+        return None
+    start, end = [v.strip() for v in spec.split("-", 1)]
+    try:
+        if not start:       # last n bytes
+            return max(length - int(end), 0), length
+        if not end:
+            return int(start), length
+        return int(start), min(int(end) + 1, length)
+    except ValueError:
+        return None
+
 class BaseHandler(tornado.web.RequestHandler):
 
     @property
@@ -37,17 +117,136 @@ class BaseHandler(tornado.web.RequestHandler):
     def mq(self):
         return self.application.mq
 
+    @property
+    def async_db(self):
+        return self.application.async_db
+
+    @property
+    def async_fs(self):
+        return self.application.async_fs
+
+    @property
+    def async_mq(self):
+        return self.application.async_mq
+
+    @property
+    def notifier(self):
+        return self.application.notifier
+
+    @property
+    def mail_state(self):
+        return self.application.mail_state
+
+    def request_fetches(self, mail_accounts):
+        """ queue mail accounts not fetched for a while """
+        fetch_time_interval = self.settings['fetch_time_interval']
+        imap_idle = self.settings['imap_idle']
+        for mail_account in mail_accounts:
+            if imap_idle and mail_account["protocol"] == "imap":
+                continue    # fetched by idle.py on new mails
+            request_fetch_mails(self.mq, mail_account, fetch_time_interval)
+
     def get_current_user(self):
-        user_name = self.get_secure_cookie("user")
-        if not user_name: return None
-        return self.db.get_user(name=user_name)
+        # read by load_current_user for the decorated methods only, so no
+        # query runs on the IOLoop
+        return None
+
+    def load_current_user(self, callback):
+        """ set current_user from the session cookie, then ``callback()`` """
+        user_id = self.get_secure_cookie("user_id")
+        if not user_id:
+            self._current_user = None
+            callback()
+            return
+        def on_user(user):
+            # users are cached by id in db, so this costs no query mostly
+            self._current_user = user
+            callback()
+        self.async_db.get_user(user_id, callback=on_user)
+
+    def _check_not_modified(self, etag, last_modified):
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match:
+            etags = [v.strip() for v in if_none_match.split(",")]
+            return etag in etags or "*" in etags
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since:
+            date_tuple = email.utils.parsedate(if_modified_since)
+            if date_tuple:
+                if_since = datetime.datetime(*date_tuple[:6])
+                return if_since >= last_modified
+        return False
+
+    def send_file(self, stored_file, filename, content_type):
+        """ send a stored file one chunk at a time
+
+        Supports conditional requests and single byte ranges. The calling
+        method must be asynchronous, the request is finished here once the
+        last chunk has been flushed.
+        """
+        etag = '"%s"' % (stored_file.md5 or stored_file._id)
+        last_modified = stored_file.upload_date.replace(microsecond=0)
+        self.set_header("Etag", etag)
+        self.set_header("Last-Modified", last_modified)
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("Content-Type", content_type)
+        self.set_header("Content-Disposition",
+                        'attachment;filename="' + filename + '"')
+        if self._check_not_modified(etag, last_modified):
+            self.set_status(304)
+            self.finish()
+            return
+
+        length = stored_file.length
+        start, end = 0, length
+        range_header = self.request.headers.get("Range")
+        if_range = self.request.headers.get("If-Range", etag)
+        if range_header and if_range == etag:
+            byte_range = _parse_range(range_header, length)
+            if byte_range is not None:
+                start, end = byte_range
+                if start >= end:
+                    self.set_status(416)
+                    self.set_header("Content-Range", "bytes */%d" % length)
+                    self.finish()
+                    return
+                self.set_status(206)
+                self.set_header("Content-Range",
+                                "bytes %d-%d/%d" % (start, end - 1, length))
+        self.set_header("Content-Length", end - start)
+        stored_file.seek(start)
+        self._send_file_chunk(stored_file, end - start)
+
+    def _send_file_chunk(self, stored_file, remaining):
+        if self.request.connection.stream.closed():
+            return
+        # a chunk may be a query, so it is read in a worker thread
+        self.async_fs.read_file(stored_file,
+            min(remaining, stored_file.chunk_size),
+            callback=functools.partial(self._on_file_chunk, stored_file,
+                                       remaining))
+
+    def _on_file_chunk(self, stored_file, remaining, chunk):
+        if self.request.connection.stream.closed():
+            return
+        remaining -= len(chunk)
+        self.write(chunk)
+        if chunk and remaining > 0:
+            # read the next chunk only after this one has been sent
+            self.flush(callback=functools.partial(self._send_file_chunk,
+                                                  stored_file, remaining))
+        else:
+            self.finish()
 
 class HomeHandler(BaseHandler):
     """ user home """
 
+    @tornado.web.asynchronous
     @authenticated
+    @tornado.gen.engine
     def get(self):
-        mail_accounts = self.db.get_mail_accounts(self.current_user["_id"])
+        mail_accounts = yield tornado.gen.Task(
+            self.async_db.get_mail_accounts, self.current_user["_id"])
         self.render("home.html", mail_accounts=mail_accounts)
 
 class SettingsHandler(BaseHandler):
@@ -64,17 +263,23 @@ class SettingsHandler(BaseHandler):
 class MailAccountListHandler(BaseHandler):
     """ manage mail accounts """
 
+    @tornado.web.asynchronous
     @authenticated
+    @tornado.gen.engine
     def get(self):
-        mail_accounts = self.db.get_mail_accounts(self.current_user["_id"])
+        mail_accounts = yield tornado.gen.Task(
+            self.async_db.get_mail_accounts, self.current_user["_id"])
         self.render("mail_accounts.html", mail_accounts=mail_accounts)
 
 class MailAccountHandler(BaseHandler):
     """ single mail account view """
 
+    @tornado.web.asynchronous
     @authenticated
+    @tornado.gen.engine
     def get(self, mail_account_id):
-        mail_account = self.db.get_mail_account(mail_account_id)
+        mail_account = yield tornado.gen.Task(
+            self.async_db.get_mail_account, mail_account_id)
         if not mail_account:
             raise tornado.web.HTTPError(404, 'mail account does not exist.')
         if mail_account["user_id"] != self.current_user["_id"]:
@@ -86,9 +291,12 @@ class AddMailAccountHandler(BaseHandler):
 
     @authenticated
     def get(self):
-        self.render("add_mail_account.html")
+        self.render("add_mail_account.html",
+                    protocols=SUPPORTED_MAIL_PROTOCOLS)
 
+    @tornado.web.asynchronous
     @authenticated
+    @tornado.gen.engine
     def post(self):
         address = self.get_argument("address")
         password = self.get_argument("password")
@@ -115,7 +323,9 @@ class AddMailAccountHandler(BaseHandler):
         auto_del = True if auto_del else False
 
         # validates in db
-        if self.db.get_mail_account(address=address):
+        existing = yield tornado.gen.Task(self.async_db.get_mail_account,
+                                          address=address)
+        if existing:
             raise tornado.web.HTTPError(409, "address already exists")
 
         # Attempting authenticate to check if user is authenticated
@@ -128,9 +338,12 @@ class AddMailAccountHandler(BaseHandler):
                 p.quit()    # authentication successful
             else:
                 raise tornado.web.HTTPError(404, "login to server failed.")
-        # other protocols
-        #else:
-        #    pass
+        elif protocol == 'imap':
+            m = get_authenticated_imap(conn_params, use_ssl, username, password)
+            if m:
+                m.logout()  # authentication successful
+            else:
+                raise tornado.web.HTTPError(404, "login to server failed.")
 
         mail_account = {
             "user_id": self.current_user["_id"],
@@ -143,11 +356,12 @@ class AddMailAccountHandler(BaseHandler):
             "use_ssl": use_ssl,
             "auto_del": auto_del,
         }
-        mail_account_id = self.db.create_mail_account(mail_account)
+        mail_account_id = yield tornado.gen.Task(
+            self.async_db.create_mail_account, mail_account)
 
         # create a message to message queue for fetch mails
-        channel = 'mail_accounts:fetch_mails'
-        self.mq.send_message(channel, str(mail_account_id))
+        mail_account["_id"] = mail_account_id
+        request_fetch_mails(self.mq, mail_account)
 
         self.redirect("/mailbox/mail_account/%s/" % mail_account_id)
 
@@ -176,25 +390,32 @@ class DelMailAccountHandler(BaseHandler):
 class MailListHandler(BaseHandler):
     """ mail list in an mail account """
 
+    @tornado.web.asynchronous
     @authenticated
+    @tornado.gen.engine
     def get(self, mail_account_id=None):
-        page = self.get_argument("p", "0")
-        if not page.isdigit():
-            raise tornado.web.HTTPError(400, "page must be integer.")
-
-        page = int(page)
+        before = self.get_argument("before", None)
+        after = self.get_argument("after", None)
+        for cursor in (before, after):
+            if cursor:
+                try:
+                    decode_mail_cursor(cursor)
+                except ValueError:
+                    raise tornado.web.HTTPError(400, "invalid page.")
+        folder = self.get_argument("folder", "INBOX")
         batch_size = self.settings['batch_size']
-        skip = page * batch_size
 
         if mail_account_id is None:
             mail_account = None
             # query user all mails
             user_id = self.current_user['_id']
-            mail_accounts = list(self.db.get_mail_accounts(user_id))
+            mail_accounts = yield tornado.gen.Task(
+                self.async_db.get_mail_accounts, user_id)
             mail_account_ids = [ma["_id"] for ma in mail_accounts]
         else:
             # query for mail account
-            mail_account = self.db.get_mail_account(mail_account_id)
+            mail_account = yield tornado.gen.Task(
+                self.async_db.get_mail_account, mail_account_id)
             mail_accounts = [mail_account]
             if not mail_account:
                 raise tornado.web.HTTPError(404, 'No such mail account!')
@@ -202,39 +423,254 @@ class MailListHandler(BaseHandler):
                 raise tornado.web.HTTPError(403, "Not permit.")
             mail_account_ids = [mail_account_id]
 
-        if not page:
+        if not before and not after:
             # create messages to message queue for fetching mails
-            channel = 'mail_accounts:fetch_mails'
-            for mail_account_id in mail_account_ids:
-                self.mq.send_message(channel, str(mail_account_id))
-
-        mails, extra = self.db.get_mails(mail_account_ids=mail_account_ids,
-                                         skip=skip, limit=batch_size)
+            self.request_fetches(mail_accounts)
+
+        # ids of new mail events from here on are sent to /mailbox/updates/
+        updates_since = self.notifier.last_id
+        mails, older, newer = yield tornado.gen.Task(
+            self.async_db.get_mails, mail_account_ids=mail_account_ids,
+            before=before, after=after, limit=batch_size, folder=folder)
+        folders = yield tornado.gen.Task(self.async_db.get_folders,
+                                         mail_account_ids)
+        if "INBOX" not in folders:
+            folders.insert(0, "INBOX")
 
         self.render("mails.html", mail_accounts=mail_accounts, mails=mails,
-                    extra=extra, page=page)
+                    older=older, newer=newer, updates_since=updates_since,
+                    folder=folder, folders=folders)
+
+class UpdatesHandler(BaseHandler):
+    """ long poll for the mails fetched after a new mail event id
+
+    Answers at once with the new mails of events after ``since``, or waits
+    up to UPDATES_TIMEOUT seconds for the next ones. The mail accounts are
+    queued for fetching on every poll, so an open page stays up to date.
+    """
+
+    @tornado.web.asynchronous
+    @authenticated
+    @tornado.gen.engine
+    def get(self):
+        since = self.get_argument("since", "0")
+        if not since.isdigit():
+            raise tornado.web.HTTPError(400, "since must be integer.")
+        since = int(since)
+        mail_account_id = self.get_argument("mail_account_id", None)
+        self.user_id = str(self.current_user["_id"])
+
+        mail_accounts = yield tornado.gen.Task(
+            self.async_db.get_mail_accounts, self.user_id)
+        if mail_account_id:
+            mail_accounts = [ma for ma in mail_accounts
+                             if str(ma["_id"]) == mail_account_id]
+            if not mail_accounts:
+                raise tornado.web.HTTPError(404, 'No such mail account!')
+        self.request_fetches(mail_accounts)
+
+        events = self.notifier.get_events(self.user_id, since)
+        if not events:
+            events = yield tornado.gen.Task(self._wait_events)
+        cursor = events[-1]["id"] if events else \
+            min(since, self.notifier.last_id)
+        if mail_account_id:
+            events = [event for event in events
+                      if event["mail_account_id"] == mail_account_id]
+
+        counts, mail_ids = {}, []
+        for event in events:
+            counts[event["mail_account_id"]] = {
+                "mail_count": event["mail_count"],
+                "unseen_count": event["unseen_count"],
+            }
+            mail_ids.extend(event["mail_ids"])
+        mails = []
+        if mail_ids:
+            mails = yield tornado.gen.Task(self.async_db.get_mails_by_ids,
+                mail_ids, MAIL_LIST_FIELDS, deleted=False)
+            mails.sort(key=lambda mail: mail["dat"], reverse=True)
+        self.write({
+            "since": cursor,
+            "mail_accounts": counts,
+            "mails": _get_json(mails),
+        })
+        self.finish()
+
+    def _wait_events(self, callback):
+        io_loop = tornado.ioloop.IOLoop.instance()
+        def on_events(events):
+            io_loop.remove_timeout(self._timeout)
+            self.notifier.cancel_wait(self.user_id, on_events)
+            callback(events)
+        self._on_events = on_events
+        self.notifier.wait(self.user_id, on_events)
+        self._timeout = io_loop.add_timeout(time.time() + UPDATES_TIMEOUT,
+                                            lambda: on_events([]))
+
+    def on_connection_close(self):
+        on_events = getattr(self, "_on_events", None)
+        if on_events is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._timeout)
+            self.notifier.cancel_wait(self.user_id, on_events)
+
+class BaseAPIHandler(BaseHandler):
+    """ json views of mails, ``fields`` selects the fields sent
+
+    Errors are sent as json too, ``{"error": message}``.
+    """
+
+    def write_error(self, status_code, **kwargs):
+        message = httplib.responses.get(status_code, "Unknown")
+        exc_info = kwargs.get("exc_info")
+        if exc_info and isinstance(exc_info[1], tornado.web.HTTPError) and \
+            exc_info[1].log_message:
+            message = exc_info[1].log_message
+        self.write({"error": message})
+        self.finish()
+
+    def get_fields(self, default):
+        fields = self.get_argument("fields", "")
+        if not fields:
+            return default
+        fields = [field.strip() for field in fields.split(",")]
+        for field in fields:
+            if field not in API_MAIL_FIELDS:
+                raise tornado.web.HTTPError(400, "unknown field %s." % field)
+        return fields
+
+class MailListAPIHandler(BaseAPIHandler):
+    """ a page of mails of the user or of a mail account as json
+
+    Pages are chained with the ``older`` and ``newer`` cursors of the
+    response, given back as ``before`` and ``after``.
+    """
+
+    @tornado.web.asynchronous
+    @api_authenticated
+    @tornado.gen.engine
+    def get(self, mail_account_id=None):
+        before = self.get_argument("before", None)
+        after = self.get_argument("after", None)
+        for cursor in (before, after):
+            if cursor:
+                try:
+                    decode_mail_cursor(cursor)
+                except ValueError:
+                    raise tornado.web.HTTPError(400, "invalid page.")
+        limit = self.get_argument("limit", str(self.settings['batch_size']))
+        if not limit.isdigit():
+            raise tornado.web.HTTPError(400, "limit must be integer.")
+        limit = min(max(int(limit), 1), API_MAX_LIMIT)
+        fields = self.get_fields(MAIL_LIST_FIELDS)
+
+        if mail_account_id is None:
+            mail_accounts = yield tornado.gen.Task(
+                self.async_db.get_mail_accounts, self.current_user['_id'])
+        else:
+            mail_account = yield tornado.gen.Task(
+                self.async_db.get_mail_account, mail_account_id)
+            if not mail_account:
+                raise tornado.web.HTTPError(404, 'No such mail account!')
+            if mail_account["user_id"] != self.current_user["_id"]:
+                raise tornado.web.HTTPError(403, "Not permit.")
+            mail_accounts = [mail_account]
+        if not before and not after:
+            self.request_fetches(mail_accounts)
+
+        mails, older, newer = yield tornado.gen.Task(
+            self.async_db.get_mails,
+            mail_account_ids=[ma["_id"] for ma in mail_accounts],
+            before=before, after=after, limit=limit, fields=fields)
+        self.write({
+            "mails": _get_json(mails),
+            "older": older,
+            "newer": newer,
+        })
+        self.finish()
+
+class MailBatchAPIHandler(BaseAPIHandler):
+    """ several mails of the user by ``ids`` as json, with one query
+
+    Mails are sent in the order of ``ids``, with their bodies and
+    attachments by default. Unknown mails are left out. Viewing mails
+    here does not mark them seen.
+    """
+
+    @tornado.web.asynchronous
+    @api_authenticated
+    @tornado.gen.engine
+    def get(self):
+        mail_ids = [mail_id.strip() for mail_id in
+                    self.get_argument("ids", "").split(",") if mail_id.strip()]
+        if len(mail_ids) > API_MAX_BATCH:
+            raise tornado.web.HTTPError(400, "too many mails.")
+        for mail_id in mail_ids:
+            if not _objectid_re.match(mail_id):
+                raise tornado.web.HTTPError(400, "invalid mail id.")
+        fields = self.get_fields(API_MAIL_FIELDS)
+
+        mail_accounts = yield tornado.gen.Task(
+            self.async_db.get_mail_accounts, self.current_user['_id'])
+        mail_account_ids = set([ma["_id"] for ma in mail_accounts])
+        mails = yield tornado.gen.Task(self.async_db.get_mails_by_ids,
+            mail_ids, list(fields) + ["mail_account_id"], deleted=False)
+        mails = [mail for mail in mails
+                 if mail["mail_account_id"] in mail_account_ids]
+        if "mail_account_id" not in fields:
+            for mail in mails:
+                del mail["mail_account_id"]
+        self.write({"mails": _get_json(mails)})
+        self.finish()
+
+class SearchHandler(BaseHandler):
+    """ search mails of all mail accounts """
+
+    @tornado.web.asynchronous
+    @authenticated
+    @tornado.gen.engine
+    def get(self):
+        query = self.get_argument("q", "")
+        page = self.get_argument("p", "0")
+        if not page.isdigit():
+            raise tornado.web.HTTPError(400, "page must be integer.")
+
+        page = int(page)
+        batch_size = self.settings['batch_size']
+        terms = tokenize(query)
+        mails, total, truncated = [], 0, False
+        if terms:
+            mails, total, truncated = yield tornado.gen.Task(
+                self.async_db.search_mails, self.current_user["_id"], terms,
+                skip=page * batch_size, limit=batch_size)
+        self.render("search.html", query=query, mails=mails, total=total,
+                    truncated=truncated, page=page, batch_size=batch_size)
 
 class MailHandler(BaseHandler):
     """ single mail view """
 
+    @tornado.web.asynchronous
     @authenticated
+    @tornado.gen.engine
     def get(self, mail_id):
-        mail = self.db.get_mail(mail_id)
-        if not mail:
+        mail = yield tornado.gen.Task(self.async_db.get_mail, mail_id)
+        if not mail or mail.get("deleted"):
             raise tornado.web.HTTPError(404, 'mail does not exist.')
         mail_account_id = mail["mail_account_id"]
-        mail_account = self.db.get_mail_account(mail_account_id)
+        mail_account = yield tornado.gen.Task(
+            self.async_db.get_mail_account, mail_account_id)
         if not mail_account:
             raise tornado.web.HTTPError(404, 'Not found!')
         if mail_account["user_id"] != self.current_user["_id"]:
             raise tornado.web.HTTPError(403, "Not permit.")
 
-        # attachments
-        mail["attachments"] = []
-        if mail["attachment_ids"]:
-            attachment_ids = mail.pop("attachment_ids")
-            for attachment_id in attachment_ids:
-                attachment = self.fs.get_file(attachment_id)
+        # attachments, mails stored before per mail attachment names were
+        # kept need to look them up in fs
+        if "attachments" not in mail:
+            mail["attachments"] = []
+            for attachment_id in mail["attachment_ids"]:
+                attachment = yield tornado.gen.Task(
+                    self.async_fs.get_file, attachment_id)
                 if attachment:
                     attachment = {
                         "_id": attachment_id,
@@ -243,79 +679,166 @@ class MailHandler(BaseHandler):
                     }
                     mail["attachments"].append(attachment)
 
-        self.db.update_mail(mail_id, seen=True)
+        if not mail.get("body_fetched", True):
+            # stored with headers only, fetch this body before the others
+            self.mq.send_message(FETCH_BODIES_CHANNEL,
+                                 "%s:%s" % (mail_account_id, mail["_id"]),
+                                 unique=True, first=True)
+
+        if not mail["seen"]:
+            # written with those of other views, see MailStateWriter
+            self.mail_state.update([mail_id], seen=True)
         self.render("mail.html", mail=mail, mail_account=mail_account)
 
+class MailStateHandler(BaseHandler):
+    """ mark many mails read or unread, delete or move them at once
+
+    ``ids`` are given as several arguments or joined by commas. Redirects
+    to ``next`` if given, otherwise answers how many mails changed.
+    """
+
+    actions = {
+        "read": {"seen": True},
+        "unread": {"seen": False},
+        "delete": {"deleted": True},
+    }
+
+    @tornado.web.asynchronous
+    @authenticated
+    @tornado.gen.engine
+    def post(self):
+        mail_ids = []
+        for ids in self.get_arguments("ids"):
+            mail_ids.extend([mail_id.strip() for mail_id in ids.split(",")
+                             if mail_id.strip()])
+        for mail_id in mail_ids:
+            if not _objectid_re.match(mail_id):
+                raise tornado.web.HTTPError(400, "invalid mail id.")
+        action = self.get_argument("action")
+        if action == "move":
+            folder = self.get_argument("folder", "").strip()
+            if not folder:
+                raise tornado.web.HTTPError(400, "folder is required.")
+            changes = {"folder": folder}
+        elif action in self.actions:
+            changes = self.actions[action]
+        else:
+            raise tornado.web.HTTPError(400, "unknown action.")
+
+        changed = 0
+        if mail_ids:
+            # seen flags of viewed mails still buffered would undo these
+            self.mail_state.discard(mail_ids, *changes.keys())
+            mail_accounts = yield tornado.gen.Task(
+                self.async_db.get_mail_accounts, self.current_user['_id'])
+            mail_account_ids = [ma["_id"] for ma in mail_accounts]
+            changed = yield tornado.gen.Task(self.async_db.update_mails,
+                mail_ids, mail_account_ids=mail_account_ids, **changes)
+            if changes.get("deleted"):
+                # attachments are shared by content, drop the references
+                # of the deleted mails
+                attachment_ids = yield tornado.gen.Task(
+                    self.async_db.clear_deleted_attachment_ids, mail_ids,
+                    mail_account_ids=mail_account_ids)
+                for attachment_id in attachment_ids:
+                    yield tornado.gen.Task(self.async_fs.release_attachment,
+                                           attachment_id)
+        next_url = self.get_argument("next", None)
+        if next_url:
+            # only to pages of this site
+            if not _local_path_re.match(next_url):
+                raise tornado.web.HTTPError(400, "invalid next.")
+            self.redirect(next_url)
+            return
+        self.write({"changed": changed})
+        self.finish()
+
 class ExportMailHandler(BaseHandler):
     """ export raw mail message """
 
+    @tornado.web.asynchronous
     @authenticated
+    @tornado.gen.engine
     def get(self, mail_id):
-        mail = self.db.get_mail(mail_id)
+        mail = yield tornado.gen.Task(self.async_db.get_mail, mail_id)
         if not mail:
             raise tornado.web.HTTPError(404, 'mail does not exist.')
 
         # check authorization
         mail_account_id = mail["mail_account_id"]
-        mail_account = self.db.get_mail_account(mail_account_id)
+        mail_account = yield tornado.gen.Task(
+            self.async_db.get_mail_account, mail_account_id)
         if not mail_account:
             raise tornado.web.HTTPError(404, 'Not found!')
         if mail_account["user_id"] != self.current_user["_id"]:
             raise tornado.web.HTTPError(403, "Not permit.")
 
         file_id = mail["fs_id"]
-        msg_file = self.fs.get_file(file_id)
-        msg_data = msg_file.read()
-        self.set_header('Content-Type', msg_file.content_type)
-        self.set_header('Content-Disposition',
-                    'attachment;filename="' + msg_file.filename + '.eml"')
-        self.write(msg_data)
+        if file_id is None:
+            raise tornado.web.HTTPError(404, 'mail body is not fetched yet.')
+        msg_file = yield tornado.gen.Task(self.async_fs.get_file, file_id)
+        self.send_file(msg_file, msg_file.filename + '.eml',
+                       msg_file.content_type)
 
 class AttachmentHandler(BaseHandler):
 
+    @tornado.web.asynchronous
     @authenticated
-    def get(self, attachment_id):
-        # check authorization
-        mail = self.db.get_mail(attachment_id=attachment_id)
-        if not mail:
+    @tornado.gen.engine
+    def get(self, mail_id, attachment_id):
+        # check authorization, attachments are shared by all mails with the
+        # same content so check the mail they are downloaded from
+        if not _objectid_re.match(attachment_id):
+            raise tornado.web.HTTPError(404, 'Attachment does not exist.')
+        mail = yield tornado.gen.Task(self.async_db.get_mail, mail_id)
+        if not mail or mail.get("deleted"):
             raise tornado.web.HTTPError(404, 'mail does not exist.')
+        if ObjectId(attachment_id) not in mail["attachment_ids"]:
+            raise tornado.web.HTTPError(404, 'Attachment does not exist.')
         mail_account_id = mail["mail_account_id"]
-        mail_account = self.db.get_mail_account(mail_account_id)
+        mail_account = yield tornado.gen.Task(
+            self.async_db.get_mail_account, mail_account_id)
         if not mail_account:
             raise tornado.web.HTTPError(404, 'Not found!')
         if mail_account["user_id"] != self.current_user["_id"]:
             raise tornado.web.HTTPError(403, "Not permit.")
 
-        attachment = self.fs.get_file(attachment_id)
+        attachment = yield tornado.gen.Task(self.async_fs.get_file,
+                                            attachment_id)
         if not attachment:
             raise tornado.web.HTTPError(404, 'Attachment does not exist.')
-        attachment_data = attachment.read()
-        self.set_header('Content-Type', attachment.content_type)
-        self.set_header('Content-Disposition',
-                    'attachment;filename="' + attachment.filename + '"')
-        self.write(attachment_data)
+        filename = attachment.filename
+        content_type = attachment.content_type
+        for attachment_info in mail.get("attachments", []):
+            if str(attachment_info["_id"]) == attachment_id:
+                filename = attachment_info["filename"]
+                content_type = attachment_info["content_type"]
+        self.send_file(attachment, filename, content_type)
 
 class LogoutHandler(BaseHandler):
     def get(self):
-        self.clear_cookie("user")
+        self.clear_cookie("user_id")
         self.redirect(self.get_argument("next", "/mailbox/"))
 
 class RegisterHandler(BaseHandler):
     def get(self):
         self.render("register.html")
 
+    @tornado.web.asynchronous
+    @tornado.gen.engine
     def post(self):
         name = self.get_argument("name")
         password = self.get_argument("password")
         if not (validate_username(name) and validate_password(password)):
             raise tornado.web.HTTPError(400, "name or password is invalid.")
-        if self.db.get_user(name=name):
+        existing = yield tornado.gen.Task(self.async_db.get_user, name=name)
+        if existing:
             raise tornado.web.HTTPError(400, "name already exists.")
         user = {
             "name": name,
             "password": password,
         }
-        self.db.create_user(user)
+        yield tornado.gen.Task(self.async_db.create_user, user)
         self.redirect("/mailbox/")
 
 class ProfileHandler(BaseHandler):
@@ -329,28 +852,50 @@ class ProfileHandler(BaseHandler):
 
 class LoginHandler(BaseHandler):
 
+    @with_current_user
     def get(self):
         if self.current_user:
             self.redirect("/mailbox/")
         else:
             self.render("login.html")
 
+    @tornado.web.asynchronous
+    @tornado.gen.engine
     def post(self):
-        if self.current_user:   # logout current user first
-            self.clear_cookie("user")
+        self.clear_cookie("user_id")    # logout current user first
         user_name = self.get_argument("name")
         user_password = self.get_argument("password")
-        if self.db.check_user(user_name, user_password):
-            self.set_secure_cookie("user", str(user_name))
+        user = yield tornado.gen.Task(self.async_db.check_user, user_name,
+                                      user_password)
+        if user:
+            self.set_secure_cookie("user_id", str(user["_id"]))
             self.redirect(self.get_argument("next", "/mailbox/"))
         else:
             self.redirect(self.settings["login_url"])
 
+class HealthHandler(BaseHandler):
+    """ whether db, fs and mq answer, with status 503 if any does not """
+
+    @tornado.web.asynchronous
+    @tornado.gen.engine
+    def get(self):
+        health = {}
+        health["db"] = yield tornado.gen.Task(self.async_db.ping)
+        health["fs"] = yield tornado.gen.Task(self.async_fs.ping)
+        health["mq"] = yield tornado.gen.Task(self.async_mq.ping)
+        if not all(health.values()):
+            self.set_status(503)
+        self.write(health)
+        self.finish()
+
 class InitHandler(BaseHandler):
     """ initialize db indexes and ... """
 
+    @tornado.web.asynchronous
+    @tornado.gen.engine
     def get(self):
-        self.db.init_indexes()
+        yield tornado.gen.Task(self.async_db.init_indexes)
+        yield tornado.gen.Task(self.async_fs.init_indexes)
         self.redirect("/mailbox/")
 
 urls_mapping = [
@@ -362,13 +907,20 @@ urls_mapping = [
     (r"/mailbox/mail_account/(\w+)/edit/", EditMailAccountHandler),
     (r"/mailbox/mail_account/(\w+)/del/", DelMailAccountHandler),
     (r"/mailbox/mails/", MailListHandler),
+    (r"/mailbox/mails/state/", MailStateHandler),
     (r"/mailbox/mails/(\w+)/", MailListHandler),
+    (r"/mailbox/search/", SearchHandler),
+    (r"/mailbox/updates/", UpdatesHandler),
+    (r"/mailbox/api/mails/", MailListAPIHandler),
+    (r"/mailbox/api/mails/batch/", MailBatchAPIHandler),
+    (r"/mailbox/api/mails/(\w+)/", MailListAPIHandler),
     (r"/mailbox/mail/(\w+)/", MailHandler),
     (r"/mailbox/mail/(\w+)/export/", ExportMailHandler),
-    (r"/mailbox/attachment/(\w+)/", AttachmentHandler),
+    (r"/mailbox/mail/(\w+)/attachment/(\w+)/", AttachmentHandler),
     (r"/mailbox/login/", LoginHandler),
     (r"/mailbox/logout/", LogoutHandler),
     (r"/mailbox/register/", RegisterHandler),
     (r"/mailbox/profile/", ProfileHandler),
+    (r"/mailbox/health/", HealthHandler),
     (r"/mailbox/init/", InitHandler),
 ]
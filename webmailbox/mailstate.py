@@ -0,0 +1,57 @@
+import logging
+
+import tornado.ioloop
+
+__all__ = [
+    "MailStateWriter",
+]
+
+class MailStateWriter(object):
+    """ coalesce state changes of mails made by many requests
+
+    Changes of seen, deleted and folder are kept as sets of mail ids per
+    new value and written every ``interval`` seconds with one bulk update
+    each, see update_mails of the db connection. The last change of a field
+    of a mail wins, so only the state it ends up in is written.
+    """
+
+    fields = ("seen", "deleted", "folder")
+
+    def __init__(self, async_db, interval=1, io_loop=None):
+        self.async_db = async_db
+        self.interval = interval
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.changes = {}   # (field, value): set of mail ids
+
+    def start(self):
+        tornado.ioloop.PeriodicCallback(self.flush, self.interval * 1000,
+                                        self.io_loop).start()
+
+    def update(self, mail_ids, **kwargs):
+        mail_ids = set([str(mail_id) for mail_id in mail_ids])
+        for field, value in kwargs.items():
+            if field not in self.fields:
+                raise ValueError("can not buffer changes of %s" % field)
+            for (other_field, other_value), ids in self.changes.items():
+                if other_field == field and other_value != value:
+                    ids.difference_update(mail_ids)
+            self.changes.setdefault((field, value), set()).update(mail_ids)
+
+    def discard(self, mail_ids, *fields):
+        """ drop the pending changes of ``fields`` of mails
+
+        For changes written at once by others, which a later flush must
+        not overwrite.
+        """
+        mail_ids = set([str(mail_id) for mail_id in mail_ids])
+        for (field, value), ids in self.changes.items():
+            if field in fields:
+                ids.difference_update(mail_ids)
+
+    def flush(self):
+        changes, self.changes = self.changes, {}
+        for (field, value), mail_ids in changes.items():
+            if mail_ids:
+                logging.debug("flush %s=%r of %d mails" % \
+                    (field, value, len(mail_ids)))
+                self.async_db.update_mails(list(mail_ids), **{field: value})
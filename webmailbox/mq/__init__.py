@@ -1,6 +1,10 @@
-import logging
+from webmailbox.connection import connect
 
-def get_mq(settings):
+def get_mq(settings, pool_size=None):
+    """ a mq connection with at most ``pool_size`` sockets, or unbounded
+
+    Raises if no connection can be made after some retries.
+    """
     mqtype = settings.MQ_TYPE
     if mqtype == 'redis':
         host = settings.MQ_HOST
@@ -8,9 +12,8 @@ def get_mq(settings):
         password = settings.MQ_PASSWORD
         password = password if password else None
         from redis_engine import MQConnection
-        try:
-            return MQConnection(host, port, password)
-        except:
-            logging.error('Can not get connection...')
+        return connect(lambda: MQConnection(host, port, password,
+                                            pool_size=pool_size),
+                       MQConnection.transient_errors)
     else:
-        logging.warning("%s not supported now." % mqtype)
+        raise ValueError("%s not supported now." % mqtype)
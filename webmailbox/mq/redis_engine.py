@@ -1,19 +1,155 @@
+import time
+import logging
 import redis
 
+from webmailbox.connection import ReconnectingConnection, retry_transient
+
 __all__ = [
     "MQConnection"
 ]
 
-class MQConnection(object):
+@retry_transient
+class MQConnection(ReconnectingConnection):
+    """ message queues in redis with at most ``pool_size`` sockets """
+
+    transient_errors = (redis.ConnectionError,)
+    # a message sent twice is received twice, a pop whose reply was lost
+    # would take another message, listen is a generator
+    not_retried = ('send_message', 'get_message', 'get_messages',
+                   'get_any_message', 'publish', 'listen')
+    # seconds a message sent with unique keeps equal ones out at most
+    unique_ttl = 600
 
     def __init__(self, host='localhost', port=6379, password=None,
-                 database=None, **kwargs):
+                 database=None, pool_size=None, **kwargs):
+        super(MQConnection, self).__init__()
         if database:
             kwargs['db'] = database
-        self.db = redis.Redis(host, port, password=password, **kwargs)
+        self.host = host
+        self.port = port
+        pool = redis.ConnectionPool(host=host, port=port, password=password,
+                                    max_connections=pool_size, **kwargs)
+        self.db = redis.Redis(connection_pool=pool)
+        self.db.ping()  # fail here instead of on the first message
+
+    def reconnect(self):
+        self.db.connection_pool.disconnect()
+
+    def ping(self):
+        try:
+            return self.db.ping()
+        except Exception:
+            logging.warning('Redis on %s:%s does not answer' % \
+                (self.host, self.port), exc_info=True)
+            return False
+
+    def send_message(self, channel, message, unique=False, first=False):
+        """ push a message to the channel
+
+        With ``unique`` the message is dropped while an equal one is still
+        pending in the channel, for ``unique_ttl`` seconds at most. With
+        ``first`` it is received before the messages already pending.
+        """
+        if unique and not self._mark_pending(channel, message):
+            return
+        if first:
+            self.db.lpush('mq:%s' % channel, message)
+        else:
+            self.db.rpush('mq:%s' % channel, message)
+
+    def _get_pending_key(self, channel, message):
+        return 'mq:%s:pending:%s' % (channel, message)
+
+    def _mark_pending(self, channel, message):
+        """ mark a message pending, False if it is already
+
+        The mark holds the time it was set. A mark left behind, by a pop
+        failing before it removed the mark or a push failing after it was
+        set, is older than ``unique_ttl`` and taken over, so a message is
+        never kept out for good.
+        """
+        key = self._get_pending_key(channel, message)
+        now = time.time()
+        if self.db.setnx(key, now):
+            return True
+        marked = self.db.get(key)
+        if marked is not None and float(marked) >= now - self.unique_ttl:
+            return False
+        # only one of several senders gets the stale time back
+        marked = self.db.getset(key, now)
+        return marked is None or float(marked) < now - self.unique_ttl
+
+    def _unmark_pending(self, channel, messages):
+        keys = [self._get_pending_key(channel, message)
+                for message in messages]
+        if keys:
+            self.db.delete(*keys)
+
+    def get_message(self, channel, timeout=None):
+        """ pop one message, waiting up to ``timeout`` seconds for it
+
+        ``timeout=None`` returns at once, ``timeout=0`` waits forever.
+        """
+        key = 'mq:%s' % channel
+        if timeout is None:
+            message = self.db.lpop(key)
+            if message:
+                self._unmark_pending(channel, [message])
+            return message
+        item = self.db.blpop(key, timeout)
+        if item:
+            message = item[1]
+            self._unmark_pending(channel, [message])
+            return message
+
+    def get_messages(self, channel, count, timeout=None):
+        """ pop up to ``count`` messages in one round trip
+
+        With a ``timeout`` it waits like ``get_message`` until at least one
+        message is available.
+        """
+        key = 'mq:%s' % channel
+        messages = []
+        if timeout is not None:
+            message = self.get_message(channel, timeout)
+            if not message:
+                return messages
+            messages.append(message)
+            count -= 1
+        if count > 0:
+            pipe = self.db.pipeline()
+            pipe.lrange(key, 0, count - 1)
+            pipe.ltrim(key, count, -1)
+            popped = pipe.execute()[0]
+            self._unmark_pending(channel, popped)
+            messages.extend(popped)
+        return messages
+
+    def get_any_message(self, channels, timeout=0):
+        """ wait up to ``timeout`` seconds for a message of any channel
+
+        Channels are checked in the given order. Returns
+        ``(channel, message)`` or None.
+        """
+        keys = ['mq:%s' % channel for channel in channels]
+        item = self.db.blpop(keys, timeout)
+        if item:
+            key, message = item
+            channel = key[len('mq:'):]
+            self._unmark_pending(channel, [message])
+            return channel, message
+
+    def publish(self, channel, message):
+        """ send a message to the current listeners of the channel only """
+        self.db.publish('mq:%s' % channel, message)
 
-    def send_message(self, channel, message):
-        self.db.rpush('mq:%s' % channel, message)
+    def listen(self, channels):
+        """ yield ``(channel, message)`` for messages published afterwards
 
-    def get_message(self, channel):
-        return self.db.lpop('mq:%s' % channel)
+        Blocks while waiting for them, so it needs a thread of its own.
+        """
+        pubsub = self.db.pubsub()
+        pubsub.subscribe(['mq:%s' % channel for channel in channels])
+        for item in pubsub.listen():
+            if item['type'] == 'message':
+                yield item['channel'][len('mq:'):], item['data']
@@ -0,0 +1,80 @@
+import time
+import logging
+import functools
+import threading
+
+import tornado.ioloop
+import tornado.escape
+
+from webmailbox.constants import NEW_MAILS_CHANNEL
+
+__all__ = [
+    "NewMailNotifier",
+]
+
+class NewMailNotifier(object):
+    """ hand new mail events of the fetcher to waiting requests
+
+    A thread listens to NEW_MAILS_CHANNEL and passes the events on to the
+    IOLoop. There every event gets an increasing id and is kept in a short
+    cache, so a client asking for the events after the last id it received
+    misses none between two requests, then the callbacks waiting for events
+    of its user are called.
+    """
+
+    cache_size = 200
+
+    def __init__(self, mq, io_loop=None):
+        self.mq = mq
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.waiters = {}   # user id: set of callbacks
+        self.cache = []
+        self.last_id = 0
+
+    def start(self):
+        listener = threading.Thread(target=self._listen, name="notifier")
+        listener.setDaemon(True)
+        listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                for channel, message in self.mq.listen([NEW_MAILS_CHANNEL]):
+                    self.io_loop.add_callback(
+                        functools.partial(self._on_message, message))
+            except Exception:
+                logging.error("Listening for new mails failed",
+                              exc_info=True)
+                time.sleep(1)
+
+    def _on_message(self, message):
+        event = tornado.escape.json_decode(message)
+        self.last_id += 1
+        event["id"] = self.last_id
+        self.cache.append(event)
+        if len(self.cache) > self.cache_size:
+            self.cache = self.cache[-self.cache_size:]
+        callbacks = self.waiters.pop(event["user_id"], ())
+        for callback in callbacks:
+            try:
+                callback([event])
+            except Exception:
+                logging.error("Error in new mails callback", exc_info=True)
+
+    def get_events(self, user_id, since):
+        """ cached events of a user with an id greater than ``since`` """
+        if since > self.last_id:
+            since = 0   # ids were given out before a restart
+        return [event for event in self.cache
+                if event["id"] > since and event["user_id"] == user_id]
+
+    def wait(self, user_id, callback):
+        """ call ``callback(events)`` once on the next events of a user """
+        self.waiters.setdefault(user_id, set()).add(callback)
+
+    def cancel_wait(self, user_id, callback):
+        callbacks = self.waiters.get(user_id)
+        if callbacks:
+            callbacks.discard(callback)
+            if not callbacks:
+                del self.waiters[user_id]
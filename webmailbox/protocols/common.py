@@ -0,0 +1,71 @@
+import email
+import time
+
+from webmailbox.utils import decode_mail_header, unpack_mail, \
+    get_mail_snippet
+
+__all__ = [
+    "decode_mail_headers",
+    "new_mail",
+    "store_mail_body",
+]
+
+def decode_mail_headers(message):
+    """ from, to, subject and timestamp of a message """
+    msg_from = decode_mail_header(message.get("From"), cache=True)
+    msg_to = decode_mail_header(message.get("To"), cache=True)
+    msg_subject = decode_mail_header(message.get("Subject"))
+    msg_date = decode_mail_header(message.get("Date"))
+    msg_date_tuple = email.utils.parsedate(msg_date)
+    if msg_date_tuple:
+        msg_timestamp = time.mktime(msg_date_tuple)
+    else:   # no or a broken Date header, take the time it arrives
+        msg_timestamp = time.time()
+    return msg_from, msg_to, msg_subject, msg_timestamp
+
+def new_mail(mail_account_id, uniqueid, headers, is_multipart):
+    """ a mail with headers only, see store_mail_body for the rest """
+    msg_from, msg_to, msg_subject, msg_timestamp = headers
+    return {
+        "mail_account_id": mail_account_id,
+        "uniqueid": uniqueid,
+        "frm": msg_from,
+        "to": msg_to,
+        "subject": msg_subject,
+        "dat": msg_timestamp,
+        "is_multipart": is_multipart,
+        "fs_id": None,
+        "txt": "",
+        "html": "",
+        "snippet": "",
+        "attachment_ids": [],
+        "attachments": [],
+        "body_fetched": False,
+        "seen": False,
+        "deleted": False,
+        "folder": "INBOX",
+    }
+
+def store_mail_body(fs, message):
+    """ store the attachments of a message and return its body fields """
+    msg_text, msg_html, msg_attachments = unpack_mail(message)
+    msg_attachment_ids = []
+    msg_attachment_infos = []
+    for attachment in msg_attachments:
+        attachment_id = fs.insert_attachment(attachment)
+        msg_attachment_ids.append(attachment_id)
+        msg_attachment_infos.append({
+            "_id": attachment_id,
+            "filename": attachment["filename"],
+            "content_type": attachment["content_type"],
+            "length": len(attachment["data"]),
+        })
+    return {
+        "is_multipart": message.is_multipart(),
+        "txt": msg_text,
+        "html": msg_html,
+        "snippet": get_mail_snippet(msg_text, msg_html),
+        "attachment_ids": msg_attachment_ids,
+        "attachments": msg_attachment_infos,
+        "body_fetched": True,
+    }
@@ -0,0 +1,172 @@
+import re
+import logging
+import imaplib
+import email
+import socket
+
+from webmailbox.search import get_mail_terms
+from webmailbox.protocols.common import decode_mail_headers, new_mail, \
+    store_mail_body
+
+__all__ = [
+    "get_authenticated_imap",
+    "fetch_imap_mails",
+]
+
+MAILBOX = "INBOX"
+FETCH_BATCH_SIZE = 50   # mails fetched with one UID FETCH at most
+
+_status_re = re.compile(r'(UIDVALIDITY|UIDNEXT) (\d+)')
+_uid_re = re.compile(r'UID (\d+)')
+_size_re = re.compile(r'RFC822\.SIZE (\d+)')
+
+def get_authenticated_imap(conn_params, use_ssl, username, password):
+    ## Attempting connection...
+    try:
+        if use_ssl:
+            m = imaplib.IMAP4_SSL(*conn_params)
+        else:
+            m = imaplib.IMAP4(*conn_params)
+    except socket.error as e:
+        logging.error("socket error: %s" % e)
+        return
+    ## Attempting authentication
+    try:
+        m.login(username, password)
+        return m
+    except imaplib.IMAP4.error as e:
+        logging.error("Login failed: %s" % e)
+        m.logout()
+
+def _connect_imap(mail_account):
+    address = mail_account["address"]
+    password = mail_account["password"]
+    host = mail_account["host"]
+    port = mail_account["port"]
+    use_ssl = mail_account["use_ssl"]
+    username, domain = address.split("@", 1)
+    host = host if host else domain
+    conn_params = [host, port] if port else [host]
+    return get_authenticated_imap(conn_params, use_ssl, username, password)
+
+def _get_mailbox_status(m):
+    """ UIDVALIDITY and UIDNEXT of the mailbox with one STATUS command """
+    typ, data = m.status(MAILBOX, "(UIDVALIDITY UIDNEXT)")
+    status = dict(_status_re.findall(data[0]))
+    return int(status["UIDVALIDITY"]), int(status["UIDNEXT"])
+
+def _get_batches(m, uids, max_mail_size):
+    """ split uids into UID FETCH batches of bounded count and size """
+    sizes = {}
+    for i in range(0, len(uids), FETCH_BATCH_SIZE):
+        uid_set = ",".join([str(uid) for uid in uids[i:i + FETCH_BATCH_SIZE]])
+        typ, data = m.uid("FETCH", uid_set, "(RFC822.SIZE)")
+        for item in data:
+            if not isinstance(item, str):
+                continue
+            uid, size = _uid_re.search(item), _size_re.search(item)
+            if uid and size:
+                sizes[int(uid.group(1))] = int(size.group(1))
+    batches = []
+    batch, batch_size = [], 0
+    for uid in uids:
+        size = sizes.get(uid)
+        if size is None or size > max_mail_size:
+            logging.info("Mail size too big, ignore...")
+            continue
+        if batch and (len(batch) >= FETCH_BATCH_SIZE or
+                      batch_size + size > max_mail_size):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(uid)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def _get_fetched_uid(item, rest):
+    """ the UID of a FETCH response, sent before or after the message
+
+    ``item`` is the (prefix, literal) tuple of a message, ``rest`` the
+    response line closing it, if any. Returns None without a UID.
+    """
+    for part in [item[0]] + [p for p in rest if isinstance(p, str)]:
+        uid = _uid_re.search(part)
+        if uid:
+            return int(uid.group(1))
+
+def _save_imap_message(db, fs, mail_account, uniqueid, msg_string):
+    message = email.message_from_string(msg_string)
+    mail = new_mail(mail_account["_id"], uniqueid,
+                    decode_mail_headers(message), message.is_multipart())
+    msg_file = fs.new_file(filename=mail["subject"],
+                           content_type="message/rfc822")
+    msg_file.write(msg_string)
+    msg_file.close()
+    mail["fs_id"] = msg_file._id
+    mail.update(store_mail_body(fs, message))
+    mail_id = db.save_mail(mail)  # supposed not larger than 4M for text and html
+    db.index_mail(mail_account["user_id"], mail_id, get_mail_terms(mail))
+    return mail_id
+
+def fetch_imap_mails(db, fs, mail_account, max_mail_size):
+    """ fetch mails of an IMAP mail account added since the last fetch
+
+    The mail account keeps the UIDVALIDITY and UIDNEXT of its last fetch.
+    If STATUS reports both unchanged nothing else is sent, otherwise only
+    messages above the last fetched UID are downloaded, in batches.
+    Returns the ids of the new mails.
+    """
+    mail_account_id = mail_account["_id"]
+    mail_ids = []
+    m = _connect_imap(mail_account)
+    if not m:
+        return mail_ids
+    try:
+        uidvalidity, uidnext = _get_mailbox_status(m)
+        last_uid = 0
+        if mail_account.get("imap_uidvalidity") == uidvalidity:
+            if mail_account.get("imap_uidnext") == uidnext:
+                return mail_ids
+            last_uid = mail_account.get("imap_last_uid", 0)
+        else:
+            # a new mailbox for the server, uids start from scratch
+            logging.info("UIDVALIDITY of mail account %s changed..." % \
+                mail_account_id)
+
+        m.select(MAILBOX, readonly=True)
+        typ, data = m.uid("SEARCH", None, "UID %d:*" % (last_uid + 1))
+        # n:* always matches the last message, even below n
+        uids = [int(uid) for uid in data[0].split() if int(uid) > last_uid]
+        for batch in _get_batches(m, uids, max_mail_size):
+            uniqueids = {}
+            for uid in batch:
+                uniqueids[uid] = "%s:%s" % (uidvalidity, uid)
+            # mails stored before the state was saved by a failed fetch
+            known_uniqueids = db.get_mail_uniqueids(mail_account_id,
+                                                    uniqueids.values())
+            uid_set = ",".join([str(uid) for uid in batch
+                                if uniqueids[uid] not in known_uniqueids])
+            if uid_set:
+                typ, data = m.uid("FETCH", uid_set, "(BODY.PEEK[])")
+                for i, item in enumerate(data):
+                    if not isinstance(item, tuple):
+                        continue
+                    uid = _get_fetched_uid(item, data[i + 1:i + 2])
+                    if uid not in uniqueids:
+                        logging.warning("No UID in FETCH response of mail "
+                                        "account %s, skip..." % mail_account_id)
+                        continue
+                    mail_ids.append(_save_imap_message(db, fs,
+                        mail_account, uniqueids[uid], item[1]))
+            last_uid = batch[-1]
+            db.update_mail_account(mail_account_id,
+                                   imap_uidvalidity=uidvalidity,
+                                   imap_last_uid=last_uid)
+        db.update_mail_account(mail_account_id,
+                               imap_uidvalidity=uidvalidity,
+                               imap_uidnext=uidnext,
+                               imap_last_uid=max([last_uid] + uids))
+    finally:
+        m.logout()
+    return mail_ids
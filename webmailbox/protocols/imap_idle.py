@@ -0,0 +1,183 @@
+import re
+import time
+import socket
+import logging
+
+import tornado.ioloop
+import tornado.iostream
+
+__all__ = [
+    "IdleClient",
+]
+
+MAILBOX = "INBOX"
+IDLE_TIMEOUT = 29 * 60  # servers may drop clients idling for 30 minutes
+POLL_INTERVAL = 60      # seconds between NOOPs for servers without IDLE
+MAX_RETRY_DELAY = 300
+
+_count_re = re.compile(r'\* (\d+) (EXISTS|EXPUNGE)', re.I)
+
+def _quote(arg):
+    return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
+
+class IdleClient(object):
+    """ keep the INBOX of an IMAP mail account open on the IOLoop
+
+    ``on_new_mail`` is called with the mail account once the mailbox is
+    selected, to catch up with mails received while disconnected, and then
+    whenever the server reports more messages than before. The mailbox is
+    watched with IDLE, or with NOOPs if the server does not support it, and
+    lost connections are opened again with a growing delay.
+    """
+
+    def __init__(self, mail_account, on_new_mail, io_loop=None):
+        self.mail_account = mail_account
+        self.on_new_mail = on_new_mail
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.stream = None
+        self.stopped = False
+        self.retry_delay = 1
+        self.exists = None
+        self._tag = 0
+        self._timeout = None
+
+    def start(self):
+        self._connect()
+
+    def stop(self):
+        self.stopped = True
+        self._remove_timeout()
+        if self.stream:
+            self.stream.close()
+
+    def _remove_timeout(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _set_timeout(self, seconds, callback):
+        self._remove_timeout()
+        self._timeout = self.io_loop.add_timeout(time.time() + seconds,
+                                                 callback)
+
+    def _connect(self):
+        self._timeout = None
+        mail_account = self.mail_account
+        username, domain = mail_account["address"].split("@", 1)
+        host = mail_account["host"] or domain
+        use_ssl = mail_account["use_ssl"]
+        port = mail_account["port"] or (993 if use_ssl else 143)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if use_ssl:
+            self.stream = tornado.iostream.SSLIOStream(sock,
+                                                       io_loop=self.io_loop)
+        else:
+            self.stream = tornado.iostream.IOStream(sock, io_loop=self.io_loop)
+        self.stream.set_close_callback(self._on_close)
+        self.exists = None
+        try:
+            self.stream.connect((host, port), self._read_greeting)
+        except socket.error as e:
+            logging.error("socket error: %s" % e)
+            self.stream.close()
+
+    def _on_close(self):
+        self._remove_timeout()
+        self.stream = None
+        if self.stopped:
+            return
+        logging.info("IMAP connection of mail account %s lost, retry in "
+                     "%d seconds..." % (self.mail_account["_id"],
+                                        self.retry_delay))
+        self._set_timeout(self.retry_delay, self._connect)
+        self.retry_delay = min(self.retry_delay * 2, MAX_RETRY_DELAY)
+
+    def _read_line(self, callback):
+        self.stream.read_until("\r\n", callback)
+
+    def _on_untagged(self, line):
+        match = _count_re.match(line)
+        if not match:
+            return
+        number = int(match.group(1))
+        if match.group(2).upper() == "EXPUNGE":
+            if self.exists:
+                self.exists -= 1
+            return
+        if self.exists is not None and number > self.exists:
+            self.on_new_mail(self.mail_account)
+        self.exists = number
+
+    def _command(self, command, callback):
+        """ send a command, callback(ok) on its tagged response """
+        self._tag += 1
+        tag = "a%d" % self._tag
+        self.stream.write("%s %s\r\n" % (tag, command))
+        def on_line(line):
+            if line.startswith(tag + " "):
+                callback(line[len(tag) + 1:].upper().startswith("OK"))
+            else:
+                self._on_untagged(line)
+                self._read_line(on_line)
+        self._read_line(on_line)
+
+    def _read_greeting(self):
+        self._read_line(self._on_greeting)
+
+    def _on_greeting(self, line):
+        if not line.upper().startswith("* OK"):
+            logging.error("IMAP server refused: %s" % line.strip())
+            self.stream.close()
+            return
+        username = self.mail_account["address"].split("@", 1)[0]
+        password = self.mail_account["password"]
+        self._command("LOGIN %s %s" % (_quote(username), _quote(password)),
+                      self._on_login)
+
+    def _on_login(self, ok):
+        if not ok:
+            logging.error("Login failed: %s" % self.mail_account["address"])
+            self.stream.close()
+            return
+        self._command("EXAMINE %s" % MAILBOX, self._on_examine)
+
+    def _on_examine(self, ok):
+        if not ok:
+            logging.error("EXAMINE failed: %s" % self.mail_account["address"])
+            self.stream.close()
+            return
+        self.retry_delay = 1
+        self.on_new_mail(self.mail_account)
+        self._idle()
+
+    def _idle(self):
+        self._tag += 1
+        tag = "a%d" % self._tag
+        self.stream.write("%s IDLE\r\n" % tag)
+        def on_line(line):
+            if line.startswith(tag + " "):
+                self._remove_timeout()
+                if line[len(tag) + 1:].upper().startswith("OK"):
+                    self._idle()    # ended by DONE, idle again
+                else:
+                    logging.info("IDLE not supported by %s, polling..." % \
+                        self.mail_account["address"])
+                    self._set_timeout(POLL_INTERVAL, self._poll)
+                return
+            if line.startswith("+"):
+                self._set_timeout(IDLE_TIMEOUT, self._done)
+            else:
+                self._on_untagged(line)
+            self._read_line(on_line)
+        self._read_line(on_line)
+
+    def _done(self):
+        self._timeout = None
+        self.stream.write("DONE\r\n")
+
+    def _poll(self):
+        self._timeout = None
+        self._command("NOOP", self._on_noop)
+
+    def _on_noop(self, ok):
+        self._set_timeout(POLL_INTERVAL, self._poll)
@@ -1,14 +1,17 @@
 import logging
 import poplib
 import email
-import time
+import email.feedparser
 import socket
 
-from webmailbox.utils import decode_mail_header, unpack_mail
+from webmailbox.search import get_mail_terms
+from webmailbox.protocols.common import decode_mail_headers, new_mail, \
+    store_mail_body
 
 __all__ = [
     "get_authenticated_pop3",
     "fetch_pop3_mails",
+    "fetch_pop3_mail_bodies",
 ]
 
 def get_authenticated_pop3(conn_params, use_ssl, username, password):
@@ -40,8 +43,52 @@ def get_authenticated_pop3(conn_params, use_ssl, username, password):
             logging.error("Login failed: %s" % e)
             p.quit()
 
-def fetch_pop3_mails(db, fs, mail_account, max_mail_size):
-    mail_account_id = mail_account["_id"]
+def _get_pop3_uniqueids(p):
+    """ map message numbers to unique ids with one UIDL command """
+    uniqueids = {}
+    try:
+        # Attempting UIDL
+        response, listings, octets = p.uidl()
+    except poplib.error_proto as e:
+        logging.info("Server does not support UIDL: %s" % e)
+        return uniqueids
+    for listing in listings:
+        number, uniqueid = listing.split(None, 1)
+        uniqueids[number] = uniqueid.strip()
+    return uniqueids
+
+def _iter_retr_lines(p, which):
+    """ yield the lines of a message as RETR reads them off the socket """
+    p._putcmd('RETR %s' % which)
+    p._getresp()
+    line, octets = p._getline()
+    while line != '.':
+        if line[:2] == '..':
+            line = line[1:]
+        yield line
+        line, octets = p._getline()
+
+def _spool_pop3_message(p, fs, number):
+    """ RETR a message into a new file and the mail parser line by line
+
+    The message is never joined into one string, so only the parser and
+    one file chunk hold it in memory. The file is returned still open for
+    the caller to name and close.
+    """
+    parser = email.feedparser.FeedParser()
+    msg_file = fs.new_file(content_type="message/rfc822")
+    try:
+        for line in _iter_retr_lines(p, number):
+            line += '\n'
+            msg_file.write(line)
+            parser.feed(line)
+    except:
+        msg_file.close()
+        fs.delete_file(msg_file._id)
+        raise
+    return parser.close(), msg_file
+
+def _connect_pop3(mail_account):
     address = mail_account["address"]
     password = mail_account["password"]
     host = mail_account["host"]
@@ -50,94 +97,154 @@ def fetch_pop3_mails(db, fs, mail_account, max_mail_size):
     username, domain = address.split("@", 1)
     host = host if host else domain
     conn_params = [host, port] if port else [host]
-    p = get_authenticated_pop3(conn_params, use_ssl, username, password)
+    return get_authenticated_pop3(conn_params, use_ssl, username, password)
+
+def fetch_pop3_mails(db, fs, mail_account, max_mail_size,
+                     headers_first=False):
+    """ fetch new mails of a POP3 mail account
+
+    Nothing but STAT is sent if it is the same as at the last fetch, kept
+    in the sync state of the mail account. Otherwise the unique ids already
+    stored are looked up with one query, so a failed fetch resumes after
+    the last mail it stored.
+
+    With ``headers_first`` new mails with a unique id are stored with their
+    headers only, see fetch_pop3_mail_bodies. Returns the ids of the new
+    mails and how many of them have headers only.
+    """
+    mail_account_id = mail_account["_id"]
+    user_id = mail_account["user_id"]
+    mail_ids = []
+    header_only_count = 0
+    p = _connect_pop3(mail_account)
     if p:
+        stat = list(p.stat())
+        sync_state = db.get_sync_state(mail_account_id)
+        if sync_state.get("stat") == stat:
+            p.quit()
+            return mail_ids, header_only_count
         response, listings, octet_count = p.list()
+        msg_uniqueids = _get_pop3_uniqueids(p)
+        known_uniqueids = db.get_mail_uniqueids(mail_account_id,
+                                                msg_uniqueids.values())
         for listing in listings:
             number, size = listing.split()
             if int(size) > max_mail_size:
                 logging.info("Mail size too big, ignore...")
                 continue
 
-            fetch_whole_message = False
+            msg_file = None
+            msg_headers = None
 
             ## check if mail already exists
-            try:
-                # Attempting UIDL
-                msg_uniqueid = p.uidl(number)
-                msg_uniqueid.split()[-1]
-            except poplib.error_proto as e:
-                logging.info("Server does not support UIDL: %s" % e)
-                msg_uniqueid = ""
+            msg_uniqueid = msg_uniqueids.get(number, "")
             if msg_uniqueid:
-                if db.get_mail(mail_account_id=mail_account_id,
-                    uniqueid=msg_uniqueid):
-                    logging.info("mail already exist...")
+                if msg_uniqueid in known_uniqueids:
                     continue
             else:
                 ## only check from, to, subject, date headers
                 try:
                     ## Attempting TOP command to get headers...
                     response, lines, octets = p.top(number, 0)
+                    message = email.message_from_string('\n'.join(lines))
                 except poplib.error_proto as e:
                     logging.info("Server does not support TOP: %s" % e)
-                    response, lines, octets = p.retr(number)
-                    fetch_whole_message = True
-                msg_string = '\n'.join(lines)
-                message = email.message_from_string(msg_string)
-                msg_from = decode_mail_header(message.get("From"))
-                msg_to = decode_mail_header(message.get("To"))
-                msg_subject = decode_mail_header(message.get("Subject"))
-                msg_date = decode_mail_header(message.get("Date"))
-                msg_date_tuple = email.utils.parsedate(msg_date)
-                msg_timestamp = time.mktime(msg_date_tuple)
+                    message, msg_file = _spool_pop3_message(p, fs, number)
+                msg_headers = decode_mail_headers(message)
+                msg_from, msg_to, msg_subject, msg_timestamp = msg_headers
                 if db.get_mail(mail_account_id=mail_account_id, frm=msg_from,
-                    to=msg_to, subject=msg_subject, time=msg_timestamp):
+                    to=msg_to, subject=msg_subject, dat=msg_timestamp):
                     logging.info("mail already exist...")
+                    if msg_file is not None:
+                        msg_file.close()
+                        fs.delete_file(msg_file._id)
+                    continue
+
+            ## store headers now and fetch the body later, mails without
+            ## unique id can not be found again for that
+            if headers_first and msg_uniqueid:
+                try:
+                    response, lines, octets = p.top(number, 0)
+                except poplib.error_proto as e:
+                    logging.info("Server does not support TOP: %s" % e)
+                else:
+                    message = email.message_from_string('\n'.join(lines))
+                    is_multipart = \
+                        message.get_content_maintype() == "multipart"
+                    mail = new_mail(mail_account_id, msg_uniqueid,
+                                    decode_mail_headers(message),
+                                    is_multipart)
+                    mail_id = db.save_mail(mail)
+                    db.index_mail(user_id, mail_id, get_mail_terms(mail))
+                    mail_ids.append(mail_id)
+                    header_only_count += 1
                     continue
 
             ## now get the whole message if only get headers before
-            if not fetch_whole_message:
-                response, lines, octets = p.retr(number)
-                msg_string = '\n'.join(lines)
-                message = email.message_from_string(msg_string)
-                msg_from = decode_mail_header(message.get("From"))
-                msg_to = decode_mail_header(message.get("To"))
-                msg_subject = decode_mail_header(message.get("Subject"))
-                msg_date = decode_mail_header(message.get("Date"))
-                msg_date_tuple = email.utils.parsedate(msg_date)
-                msg_timestamp = time.mktime(msg_date_tuple)
-
-            msg_is_multipart = message.is_multipart()
-            msg_gfs_file = {
-                "data": msg_string,
-                "filename": msg_subject,
-                "content_type": "message/rfc822",
-            }
-            msg_gfs_id = fs.insert_file(msg_gfs_file)
-            mail = {
-                "mail_account_id": mail_account_id,
-                "uniqueid": msg_uniqueid,
-                "frm": msg_from,
-                "to": msg_to,
-                "subject": msg_subject,
-                "dat": msg_timestamp,
-                "is_multipart": msg_is_multipart,
-                "fs_id": msg_gfs_id,
-                "seen": False,
-                "deleted": False,
-                "folder": "INBOX",
-            }
-
-            msg_text, msg_html, msg_attachments = unpack_mail(message)
-            msg_attachment_ids = []
-            for attachment in msg_attachments:
-                attachment_id = fs.insert_file(attachment)
-                msg_attachment_ids.append(attachment_id)
-            mail["txt"] = msg_text
-            mail["html"] = msg_html     
-            mail["attachment_ids"] = msg_attachment_ids
-            db.save_mail(mail)  # supposed not larger than 4M for text and html
+            if msg_file is None:
+                message, msg_file = _spool_pop3_message(p, fs, number)
+            ## headers from TOP are those of the whole message
+            if msg_headers is None:
+                msg_headers = decode_mail_headers(message)
+
+            mail = new_mail(mail_account_id, msg_uniqueid, msg_headers,
+                            message.is_multipart())
+            msg_file.filename = mail["subject"]
+            msg_file.close()
+            mail["fs_id"] = msg_file._id
+            mail.update(store_mail_body(fs, message))
+            mail_id = db.save_mail(mail)  # supposed not larger than 4M for text and html
+            db.index_mail(user_id, mail_id, get_mail_terms(mail))
+            mail_ids.append(mail_id)
 
+        db.set_sync_state(mail_account_id, stat=stat)
         ## commit changes, unlock mailbox, drop connection
         p.quit()
+    return mail_ids, header_only_count
+
+def fetch_pop3_mail_bodies(db, fs, mail_account, limit=100, mail_ids=None):
+    """ fetch the bodies of mails stored with headers only, newest first
+
+    Mails of ``mail_ids``, opened by the user, come before the others.
+    Returns whether mails without body are left after ``limit`` of them.
+    """
+    mails = list(db.get_mails_without_body(mail_account["_id"], limit))
+    more = len(mails) == limit
+    if mail_ids:
+        requested = [mail for mail in db.get_mails_by_ids(mail_ids,
+                         ["mail_account_id", "uniqueid", "frm", "to",
+                          "subject", "body_fetched"], deleted=False)
+                     if mail["mail_account_id"] == mail_account["_id"] and
+                        not mail["body_fetched"]]
+        requested_ids = set([mail["_id"] for mail in requested])
+        mails = requested + [mail for mail in mails
+                             if mail["_id"] not in requested_ids]
+    if not mails:
+        return False
+    p = _connect_pop3(mail_account)
+    if not p:
+        return False
+    numbers = {}
+    for number, uniqueid in _get_pop3_uniqueids(p).items():
+        numbers[uniqueid] = number
+    for mail in mails:
+        number = numbers.get(mail["uniqueid"])
+        if number is None:
+            logging.info("mail deleted from server before its body was "
+                         "fetched...")
+            db.save_mail_body(mail["_id"], {"body_fetched": True})
+            continue
+        message, msg_file = _spool_pop3_message(p, fs, number)
+        msg_file.filename = mail["subject"]
+        msg_file.close()
+        body = store_mail_body(fs, message)
+        body["fs_id"] = msg_file._id
+        db.save_mail_body(mail["_id"], body)
+        # headers were indexed with the mail already, add the other terms
+        header_terms = get_mail_terms(mail)
+        terms = get_mail_terms(dict(mail, txt=body["txt"]))
+        db.index_mail(mail_account["user_id"], mail["_id"],
+                      dict([(term, score) for term, score in terms.items()
+                            if term not in header_terms]))
+    p.quit()
+    return more
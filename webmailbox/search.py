@@ -0,0 +1,54 @@
+import re
+
+__all__ = [
+    "tokenize",
+    "get_mail_terms",
+]
+
+# fields of a mail to index and the weight of a term found in them
+FIELD_WEIGHTS = (
+    ("subject", 4),
+    ("frm", 3),
+    ("to", 2),
+    ("txt", 1),
+)
+
+MAX_TERMS = 512             # terms indexed per mail
+MAX_TEXT_LENGTH = 64 * 1024 # bytes of a field looked at
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+# chinese, japanese and korean are written without spaces
+_cjk_re = re.compile(u'([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff'
+                     u'\uac00-\ud7af\uf900-\ufaff]+)')
+
+def tokenize(text):
+    """ split utf-8 or unicode text into lower case search terms
+
+    Words shorter than two characters are dropped, runs of CJK characters
+    are split into overlapping pairs of characters.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+    terms = []
+    for word in _word_re.findall(text.lower()):
+        for i, piece in enumerate(_cjk_re.split(word)):
+            if i % 2:   # a CJK run
+                if len(piece) == 1:
+                    terms.append(piece)
+                for j in range(len(piece) - 1):
+                    terms.append(piece[j:j + 2])
+            elif len(piece) > 1:
+                terms.append(piece)
+    return terms
+
+def get_mail_terms(mail):
+    """ search terms of a mail with their scores, ``{term: score}`` """
+    scores = {}
+    for field, weight in FIELD_WEIGHTS:
+        value = mail.get(field) or ''
+        for term in tokenize(value[:MAX_TEXT_LENGTH]):
+            scores[term] = scores.get(term, 0) + weight
+    if len(scores) > MAX_TERMS:
+        best = sorted(scores.items(), key=lambda item: -item[1])
+        scores = dict(best[:MAX_TERMS])
+    return scores
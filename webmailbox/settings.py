@@ -6,13 +6,18 @@ DB_PORT = 27017
 DB_NAME = "web_mailbox"
 DB_USERNAME = ""
 DB_PASSWORD = ""
+DB_WORKERS = 10     # threads running queries for the web server
+USER_CACHE_SIZE = 1000
+USER_CACHE_TTL = 300    # seconds
 
-FS_TYPE = "mongodb"
+FS_TYPE = "mongodb"     # or "local", files on the disk under FS_PATH
+FS_PATH = "var/fs"     # relative to the directory of this file
 FS_HOST = "localhost"
 FS_PORT = 27017
 FS_NAME = "web_mailbox_fs"
 FS_USERNAME = ""
 FS_PASSWORD = ""
+FS_WORKERS = 4
 
 MQ_TYPE = "redis"
 MQ_HOST = "localhost"
@@ -26,3 +31,13 @@ COOKIE_SECRET = "sTYpYbYuSmacJpvhxfEX2rj3EjdsWEk7p+cFfFWFDxY="
 MAX_MAIL_SIZE = 10 * 1024 * 1024    # 10M
 
 BATCH_SIZE = 10
+
+FETCH_TIME_INTERVAL = 60  # seconds between two fetches of a mail account
+FETCH_CONCURRENCY = 10    # mail accounts fetched in parallel by fetch.py
+FETCH_BATCH_SIZE = 10     # mail account ids taken from the queue at once
+FETCH_WAIT_TIMEOUT = 5    # seconds to block on an empty queue
+FETCH_HEADERS_FIRST = False # store headers of new mails, bodies later
+
+IMAP_IDLE = False   # IMAP mail accounts are watched by idle.py, not polled
+IDLE_REFRESH_INTERVAL = 60  # seconds between reloads of IMAP mail accounts
+MAIL_STATE_INTERVAL = 1     # seconds between bulk writes of seen flags
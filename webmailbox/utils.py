@@ -1,20 +1,68 @@
+import re
+import base64
+import codecs
 import email
 import mimetypes
+
+from webmailbox.cache import LRUCache
 try:
     import chardet
 except ImportError:
     chardet = None
 
-def decode_text(text):
+DETECT_SAMPLE_SIZE = 4096  # bytes given to chardet
+
+# supersets of charsets commonly declared for text actually using them
+_charset_supersets = {
+    'gb2312': 'gb18030',
+    'gbk': 'gb18030',
+    'ascii': 'utf-8',
+}
+
+_codecs = {}
+
+def _lookup_codec(charset):
+    """ the python codec name of a charset or None, memoized """
+    charset = charset.lower()
+    try:
+        return _codecs[charset]
+    except KeyError:
+        pass
+    try:
+        codec = codecs.lookup(charset).name
+    except LookupError:
+        codec = None
+    codec = _charset_supersets.get(codec, codec)
+    if len(_codecs) < 256:  # charsets come from mails, keep it bounded
+        _codecs[charset] = codec
+    return codec
+
+def decode_text(text, charset=None):
+    """ convert text to utf-8
+
+    The declared charset is tried first, then utf-8, and only if both fail
+    chardet looks at the head of the text.
+    """
+    codecs_to_try = ['utf-8']
+    codec = _lookup_codec(charset) if charset else None
+    if codec and codec != 'utf-8':
+        codecs_to_try.insert(0, codec)
+    for codec in codecs_to_try:
+        try:
+            decoded_text = text.decode(codec)
+        except UnicodeDecodeError:
+            continue
+        if codec == 'utf-8':
+            return text
+        return decoded_text.encode('utf-8')
+
     text_encoding = None
     if chardet:
-        text_encoding = chardet.detect(text)['encoding']
-    if not text_encoding:
-        text_encoding = 'gb18030'   # default for chinese text
-    try:
-        return text.decode(text_encoding).encode('utf-8')
-    except UnicodeDecodeError:
-        return text_encoding
+        text_encoding = chardet.detect(text[:DETECT_SAMPLE_SIZE])['encoding']
+    codec = _lookup_codec(text_encoding) if text_encoding else None
+    if not codec:
+        codec = 'gb18030'   # default for chinese text
+    return text.decode(codec, 'replace').encode('utf-8')
 
 def _get_cleaned_header_string(s):
     if not isinstance(s, str):
@@ -27,7 +75,27 @@ def _get_cleaned_header_string(s):
         cleaned_pieces.append(piece)
     return ' '.join(cleaned_pieces)
 
-def decode_mail_header(header_string):
+# the same senders and recipients come back over and over, so address
+# headers are cached, nearly unique ones like subjects and dates are not
+_header_cache = LRUCache(10000)
+MAX_CACHED_HEADER_LENGTH = 1024
+
+def get_header_cache_info():
+    """ hits, misses and size of the decode_mail_header cache """
+    return _header_cache.info()
+
+def decode_mail_header(header_string, cache=False):
+    """ decode a RFC 2047 header value to utf-8, memoized with ``cache`` """
+    if not cache or not isinstance(header_string, str) or \
+        len(header_string) > MAX_CACHED_HEADER_LENGTH:
+        return _decode_mail_header(header_string)
+    decoded_header = _header_cache.get(header_string)
+    if decoded_header is None:
+        decoded_header = _decode_mail_header(header_string)
+        _header_cache.set(header_string, decoded_header)
+    return decoded_header
+
+def _decode_mail_header(header_string):
     header_string = _get_cleaned_header_string(header_string)
     try:
         header_items = email.Header.decode_header(header_string)
@@ -47,14 +115,19 @@ def decode_mail_header(header_string):
     except:
         return header_string
 
+def _get_attachment_data(part):
+    if part.is_multipart():     # message/rfc822, keep the enclosed message
+        return part.get_payload(0).as_string()
+    return part.get_payload(decode=True)
+
 def unpack_mail(msg, only_headers=False, exclude_headers=True):
     # TODO: headers, msg_text, msg_html, attachments
     msg_text = ""
     msg_html = ""
     if not msg.is_multipart():
         msg_payload = msg.get_payload(decode=True)
-        msg_payload = decode_text(msg_payload)
-        if msg.get_content_type == 'text/html':
+        msg_payload = decode_text(msg_payload, msg.get_content_charset())
+        if msg.get_content_type() == 'text/html':
             msg_html = msg_payload
         else:   # text/plain. or other?
             msg_text = msg_payload
@@ -79,14 +152,15 @@ def unpack_mail(msg, only_headers=False, exclude_headers=True):
                     ext = '.bin'
                 filename = 'part-%03d%s' % (counter, ext)
             attachments.append({
-                "data": part.get_payload(),
+                "data": _get_attachment_data(part),
                 "filename": filename,
                 "content_type": content_type,
                 "is_multipart": is_multipart,
             })
         else:
             part_payload = part.get_payload(decode=True)
-            part_payload = decode_text(part_payload)
+            part_payload = decode_text(part_payload,
+                                       part.get_content_charset())
             if content_type == 'text/plain':
                 msg_text = part_payload
             elif content_type == 'text/html':
@@ -97,12 +171,49 @@ def unpack_mail(msg, only_headers=False, exclude_headers=True):
                     ext = '.bin'
                 filename = 'part-%03d%s' % (counter, ext)
                 attachments.append({
-                    "data": part.get_payload(),
+                    "data": _get_attachment_data(part),
                     "filename": filename,
                     "content_type": content_type,
-                    "is_multipart": is_multipart(),
+                    "is_multipart": is_multipart,
                 })
 
         counter += 1
 
     return msg_text, msg_html, attachments
+
+_html_tag_re = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]*>',
+                          re.IGNORECASE | re.DOTALL)
+
+def get_mail_snippet(text, html, length=200):
+    """ plain text preview of a mail body for mail lists
+
+    Only the head of the body is looked at, so this takes the same time
+    for mails of any size.
+    """
+    if text:
+        snippet = text[:length * 8]
+    elif html:
+        snippet = _html_tag_re.sub(' ', html[:length * 64])
+    else:
+        return ''
+    snippet = ' '.join(snippet.decode('utf-8', 'ignore').split())
+    if len(snippet) > length:
+        snippet = snippet[:length].rstrip() + u'...'
+    return snippet.encode('utf-8')
+
+_mail_cursor_re = re.compile(r'^(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?):([0-9a-f]{24})$')
+
+def encode_mail_cursor(mail):
+    """ opaque token for the position of a mail in a mail list """
+    return base64.urlsafe_b64encode('%r:%s' % (mail['dat'], mail['_id']))
+
+def decode_mail_cursor(token):
+    """ return ``(dat, mail_id)`` of a token, ValueError if it is invalid """
+    try:
+        value = base64.urlsafe_b64decode(str(token))
+    except TypeError:
+        raise ValueError('invalid mail cursor')
+    match = _mail_cursor_re.match(value)
+    if not match:
+        raise ValueError('invalid mail cursor')
+    return float(match.group(1)), match.group(2)